@@ -10,21 +10,114 @@
 #  
 #  
 
-import sys, os, time
-from base64 import b64encode
-import subprocess
-import platform
+import sys, os, time, math
+from binascii import unhexlify, b2a_base64
+import struct
+from array import array
+
+# utmp record layout (glibc, Linux): ut_type comes first, ut_user starts at byte 44
+UTMP_RECORD_SIZE = 384
+UTMP_USER_PROCESS = 7
+# TCP states (include/net/tcp_states.h) that `ss -tun` leaves out by default
+SS_HIDDEN_STATES = ('03', '06', '07', '0A')
+TCP_STATES = (('01', 'ESTABLISHED'), ('02', 'SYN_SENT'), ('03', 'SYN_RECV'), ('04', 'FIN_WAIT1'),
+              ('05', 'FIN_WAIT2'), ('06', 'TIME_WAIT'), ('07', 'CLOSE'), ('08', 'CLOSE_WAIT'),
+              ('09', 'LAST_ACK'), ('0A', 'LISTEN'), ('0B', 'CLOSING'), ('0C', 'NEW_SYN_RECV'))
+# Bytes read from /proc/net/{tcp,udp}[6] at a time
+SOCKET_CHUNK = 256 * 1024
+# Default latency targets, override with latency_targets in tt-agent.conf
+LATENCY_TARGETS = 'eu=146.66.158.1,us=8.8.8.8,as=116.202.224.146'
+LATENCY_PROBES = 2
+POST_URL = 'http://tecqto.com/fetch-server-data'
+# Seconds a resolved post_url host is reused for before it is looked up again
+RESOLVE_TTL = 300
+# Seconds between the cron runs tt-install.py schedules, each host at its own minute of them
+CRON_PERIOD = 180
+# Bytes of unsent posts kept in tt-spool.log while the backend is unreachable
+SPOOL_SIZE = 4 * 1024 * 1024
+# Where relay mode listens for agent posts, and the bytes of posts it queues before turning agents away
+RELAY_LISTEN = '0.0.0.0:8180'
+RELAY_QUEUE_SIZE = 64 * 1024 * 1024
+# Most seconds a relayed post waits to be forwarded before the agent is told it is only queued
+RELAY_WAIT = 20
+# Per-sample rates kept by sample_counters between posts
+SAMPLE_METRICS = ('load_cpu', 'load_io', 'rx_rate', 'tx_rate')
+# Jiffy columns of the /proc/stat cpu lines, guest and guest_nice are left out as they are counted in user and nice
+CPU_CATEGORIES = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal')
+# Filesystems without a block device that disk_network = 1 adds to the disks, besides fuse.*
+NETWORK_FSTYPES = ('nfs', 'nfs4', 'cifs', 'smb3', 'ceph', 'glusterfs', '9p')
+# /proc/net/dev columns kept per interface, from the 8 receive then 8 transmit columns
+NIC_COUNTERS = (('rx_bytes', 0), ('rx_packets', 1), ('rx_errors', 2), ('rx_dropped', 3),
+                ('tx_bytes', 8), ('tx_packets', 9), ('tx_errors', 10), ('tx_dropped', 11))
+# /proc/diskstats columns kept per device, counted after the device name, sectors being 512 bytes
+DISK_COUNTERS = (('reads', 0), ('read_sectors', 2), ('read_ms', 3), ('writes', 4), ('write_sectors', 6),
+                 ('write_ms', 7), ('io_ms', 9))
+DISK_EXCLUDE = 'loop,ram,zram,fd,sr'
+# /proc/meminfo fields, in kB, and /proc/vmstat event counters read_layout picks by name
+MEMINFO_FIELDS = ('MemTotal:', 'MemFree:', 'Buffers:', 'Cached:', 'SwapTotal:', 'SwapFree:', 'MemAvailable:',
+                  'SReclaimable:', 'Dirty:', 'Writeback:')
+VMSTAT_COUNTERS = ('pgmajfault', 'pswpin', 'pswpout', 'pgscan_kswapd', 'pgscan_direct', 'oom_kill')
+# /proc/pressure files, each with a some and a full line of avg10, avg60, avg300 and total stalled us
+PSI_RESOURCES = ('cpu', 'memory', 'io')
+PSI_KINDS = ('some', 'full')
+# Attributes every post starts with, in order, the tagged name=value fields follow
+POST_ATTRIBUTES = ('version', 'uptime', 'sessions', 'processes', 'processes_array', 'filehandles', 'filehandles_limit',
+                   'os_kernel', 'os_name', 'os_arch', 'cpu_name', 'cpu_cores', 'cpu_freq', 'ram_total', 'ram_usage',
+                   'swap_total', 'swap_usage', 'disk_array', 'disk_total', 'disk_usage', 'connections', 'nic', 'ipv4',
+                   'ipv6', 'rx', 'tx', 'rx_gap', 'tx_gap', 'load', 'load_cpu', 'load_io', 'ping_eu', 'ping_us', 'ping_as')
+POST_FIELDS = len(POST_ATTRIBUTES)
+# Posts the query socket keeps for /history
+QUERY_HISTORY = 20
+# tt-state.dat layout version, and its sections in the order written
+STATE_VERSION = 1
+STATE_SECTIONS = ('counters', 'cpus', 'nics', 'procs', 'procio', 'cgroups', 'disks', 'pressure')
+# Host facts cached in tt-facts.json by use_facts, and the most seconds they are reused for
+FACT_GROUPS = {'os': ('os_kernel', 'os_name', 'machine', 'os_arch'),
+               'cpu': ('cpu_name', 'cpu_cores', 'cpu_freq'),
+               'net': ('nic', 'ipv4', 'ipv6', 'addresses')}
+FACTS_TTL = 3600
+# Programs and /proc, /sys sources the capability manifest tt-caps.json records, the directories
+# whose mtimes tell that programs were installed or removed since, and the seconds between checks
+CAPS_TOOLS = ('ss', 'netstat', 'ip', 'lscpu', 'ps', 'df', 'who', 'ping', 'timeout', 'wget')
+CAPS_SOURCES = ('/proc/self', '/proc/self/mountinfo', '/proc/net', '/proc/net/dev', '/proc/net/sockstat',
+                '/proc/pressure', '/proc/diskstats', '/proc/vmstat', '/var/run/utmp', '/run/utmp', '/sys/class/net', '/sys/block')
+CAPS_DIRS = ('/bin', '/sbin', '/usr/bin', '/usr/sbin', '/usr/local/bin', '/usr/local/sbin')
+CAPS_TTL = 300
+# Busiest processes listed in processes_array
+TOP_PROCESSES = 50
+# Busiest cgroups listed in the cgroups field, and the most seconds a cached cgroup tree is trusted for
+CGROUP_TOP = 20
+CGROUP_RESCAN = 300
+# Collectors the governor runs reduced while the host is overloaded or a run is over its budget
+GOVERNED_COLLECTORS = ('calc_processes', 'calc_connections', 'get_network_latency')
+# Default governor thresholds: 1 minute load per online cpu, pressure stall 'some avg10' percent,
+# percent of the host's cpu time over the post interval a run may use, and resident MB
+GOVERNOR_LOAD = 2.0
+GOVERNOR_PSI = 40.0
+GOVERNOR_CPU_SHARE = 1.0
+GOVERNOR_MEMORY = 64
+# ioprio_set syscall number by machine, os has no wrapper for it
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314,
+              'ppc64le': 273, 's390x': 282}
 
 # Cron path issue workaround
 if not 'sbin' in os.environ['PATH']:
     os.environ['PATH'] += ':/sbin:/usr/sbin'
 
+# Number of external programs run through check_output, for the collector profile
+forks = 0
+
 def check_output(*popenargs, **kwargs):
-    """ check_output method from subprocess module after Python 2.7 """
+    """ check_output method from subprocess module after Python 2.7, returning text on Python 3 as well """
+    import subprocess
+    global forks
     if 'stdout' in kwargs:
         raise ValueError('stdout argument not allowed, it will be overridden.')
+    forks += 1
     process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
     output, unused_err = process.communicate()
+    if not isinstance(output, str):
+        output = output.decode('utf8', 'replace')
     retcode = process.poll()
     if retcode:
         cmd = kwargs.get("args")
@@ -33,10 +126,90 @@ def check_output(*popenargs, **kwargs):
         raise subprocess.CalledProcessError(retcode, cmd, output=output)
     return output
 
+def cpu_time():
+    """ Cpu seconds used so far, ours and our children's """
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+def splay_offset(key, period):
+    """ Seconds into every period, to the ms, that key starts at: the same for a host on every run, spread across hosts """
+    import hashlib
+    digest = hashlib.md5(key.encode('utf8')).hexdigest()
+    return int(digest[:8], 16) % int(period * 1000) / 1000.0
+
+def counter_gap(now, before):
+    """ Increase of a 32 or 64 bit counter that may have wrapped, or been reset to 0, since before """
+    if now >= before:
+        return now - before
+    bits = 32 if before < 2 ** 32 else 64
+    # Going back from the upper half of its range the counter most likely wrapped, otherwise it was reset
+    if before >= 2 ** (bits - 1):
+        return now + 2 ** bits - before
+    return now
+
+def which(program):
+    """ Full path of program on PATH, like `command -v` without a shell """
+    for directory in os.environ['PATH'].split(':'):
+        path = os.path.join(directory, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+class TTsamples(object):
+    """ Fixed-size ring of float samples per metric, one array('d') each """
+    def __init__(self, metrics, capacity):
+        self.metrics = metrics
+        self.capacity = capacity
+        self.values = [array('d', [0.0]) * capacity for metric in metrics]
+        self.clear()
+    
+    def clear(self):
+        self.count = 0
+        self.pos = 0
+    
+    def add(self, sample):
+        for values, value in zip(self.values, sample):
+            values[self.pos] = value
+        self.pos = (self.pos + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+    
+    def aggregate(self):
+        """ (min, avg, max, p95) per metric over the samples held, in any order """
+        aggregates = list()
+        for values in self.values:
+            window = sorted(values[0:self.count])
+            # Nearest-rank 95th percentile
+            p95 = window[max(int(math.ceil(0.95 * self.count)) - 1, 0)]
+            aggregates.append((window[0], sum(window) / self.count, window[-1], p95))
+        return aggregates
+
 class TTagent(object):
-    def __init__(self):
+    # Collectors in the order they run, with the default daemon interval in seconds
+    collectors = [('calc_uptime', 60),
+                  ('calc_sessions', 60),
+                  ('calc_processes', 60),
+                  ('calc_filehandles', 30),
+                  ('identify_os', 3600),
+                  ('calc_hardware', 60),
+                  ('calc_connections', 30),
+                  ('get_network_latency', 180),
+                  ('calc_load', 10),
+                  ('calc_diskstats', 30),
+                  ('calc_saturation', 10),
+                  ('calc_cgroups', 30),
+                  ('sample_counters', 5)
+                  ]
+    # Payload formats by post_format in tt-agent.conf, each method sets data_post from the field strings
+    encoders = {'b64': 'encode_b64',
+                'delta': 'encode_delta'}
+    
+    def __init__(self, oneshot=True, root='/'):
         self.version = "0.11JN17"
-        self.ttagent_dir = '/etc/tecqto/'
+        # Collectors read /proc, /sys and /etc below root, which only differs from / for fixture trees
+        self.root = root
+        self.ttagent_dir = self.path('/etc/tecqto/')
         self.authlog = os.path.join(self.ttagent_dir,'tt-auth.log')
         if not os.path.isfile(self.authlog):
             print("Error: Authentication log missing. Please authenticate client and try again.")
@@ -47,40 +220,722 @@ class TTagent(object):
         authlog.close()
         self.auth = auth.split()[0]
         
-        self.msdatalog = os.path.join(self.ttagent_dir,'tt-data.log')
+        self.statelog = os.path.join(self.ttagent_dir,'tt-state.dat')
         self.ttagentlog = os.path.join(self.ttagent_dir,'tt-agent.log')
+        self.pidfile = os.path.join(self.ttagent_dir,'tt-agent.pid')
+        self.spoollog = os.path.join(self.ttagent_dir,'tt-spool.log')
+        self.factslog = os.path.join(self.ttagent_dir,'tt-facts.json')
+        self.capslog = os.path.join(self.ttagent_dir,'tt-caps.json')
+        self.postlog = os.path.join(self.ttagent_dir,'tt-post.json')
+        self.profilelog = os.path.join(self.ttagent_dir,'tt-profile.json')
+        self.read_config()
+        self.state_read = False
+        self.data = None
+        self.profile = {}
+        self.samples = TTsamples(SAMPLE_METRICS, int(self.config.get('window_samples', 64)))
+        self.sample_prev = None
+        self.cpu_counters = None
+        self.facts = None
+        self.caps = None
+        self.caps_checked = 0
+        self.splay = None
+        self.tcp_states = None
+        self.latency = {}
+        self.latency_targets = list()
+        self.proc_prev = (0, array('l'), array('d'), array('d'))
+        self.proc_io_prev = {}
+        self.processes_io = None
+        self.users = {}
+        self.cpu_prev = None
+        self.cpu_breakdown = None
+        self.disks_stale = list()
+        self.disks_stuck = set()
+        self.nic_counters = None
+        self.addresses = None
+        self.nic_prev = None
+        self.nic_rates = None
+        self.disk_counters = None
+        self.disk_prev = None
+        self.disk_rates = None
+        self.layouts = {}
+        self.meminfo = None
+        self.run_meminfo = None
+        self.pressure = None
+        self.saturation_counters = None
+        self.saturation_prev = None
+        self.vmstat_rates = None
+        self.psi_stalled = None
+        self.http_conn = None
+        self.batch_conn = None
+        self.resolved = {}
+        self.post_state = None
+        self.post_pending = None
+        self.post_status = None
+        self.post_latency = None
+        self.query_buffers = None
+        self.cgroup_root = None
+        self.cgroup_tree = None
+        self.cgroup_scanned = 0
+        self.cgroup_prev = {}
+        self.cgroups = None
+        self.cgroup_limits = None
+        self.degraded = {}
+        self.reduced = list()
+        self.governor_cpu_start = cpu_time()
         
-        self.calc_uptime()
-        self.calc_sessions()
-        self.calc_processes()
-        self.calc_filehandles()
-        self.identify_os()
-        self.calc_hardware()
-        self.calc_connections()
-        self.get_network_latency()
-        self.calc_load()
+        if oneshot:
+            self.govern(cpu_limit=True)
+            self.run()
+    
+    def read_config(self):
+        """ Optional 'key = value' settings from tt-agent.conf """
+        self.config = {}
+        configfile = os.path.join(self.ttagent_dir,'tt-agent.conf')
+        if not os.path.isfile(configfile):
+            return
+        f = open(configfile,'r')
+        for line in f.readlines():
+            line = line.split('#')[0].strip()
+            if '=' in line:
+                key, value = line.split('=', 1)
+                self.config[key.strip()] = value.strip()
+        f.close()
+    
+    def run(self):
+        self.run_meminfo = None
+        for collector, interval in self.collectors:
+            self.run_collector(collector)
+        if self.config.get('self_metrics') == '1':
+            self.write_profile()
         self.read_msdata()
         self.write_msdata()
         self.post_msdata()
     
+    def daemon(self):
+        """ Stay resident and run every collector on its own interval, posting every post_interval seconds """
+        import fcntl
+        pidfile = open(self.pidfile, 'a+')
+        try:
+            fcntl.flock(pidfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Another daemon is already running, cron just checked on it
+            return
+        pidfile.seek(0)
+        pidfile.truncate()
+        pidfile.write("{0}\n".format(os.getpid()))
+        pidfile.flush()
+        self.govern()
+        if self.config.get('query_socket', 'tt-agent.sock'):
+            self.query()
+        
+        intervals = dict((collector, float(self.config.get('interval.' + collector, interval))) for collector, interval in self.collectors)
+        post_interval = float(self.config.get('post_interval', 180))
+        # Everything runs once before the first post so all fields are set
+        next_run = dict((collector, 0) for collector in intervals)
+        next_post = self.next_slot(time.time(), post_interval) if self.config.get('splay', '1') == '1' else 0
+        while True:
+            # Collectors due together share one read of /proc/meminfo
+            self.run_meminfo = None
+            for collector, interval in self.collectors:
+                if next_run[collector] <= time.time():
+                    next_run[collector] = self.next_slot(time.time(), intervals[collector])
+                    try:
+                        self.run_collector(collector)
+                    except Exception as e:
+                        print("Error: {0} failed: {1}".format(collector, e))
+            if next_post <= time.time():
+                next_post = self.next_slot(time.time(), post_interval)
+                try:
+                    if self.config.get('self_metrics') == '1':
+                        self.write_profile()
+                    self.read_msdata()
+                    self.write_msdata()
+                    self.post_msdata()
+                except Exception as e:
+                    print("Error: Posting failed: {0}".format(e))
+                # The cpu budget is per post interval
+                self.governor_cpu_start = cpu_time()
+                sys.stdout.flush()
+            wakeup = min(min(next_run.values()), next_post)
+            time.sleep(max(wakeup - time.time(), 0.1))
+    
+    def splay_key(self):
+        """ What splay_offset spreads hosts by: the token, and the machine id as one token may serve many hosts """
+        if self.splay is None:
+            machine_id = os.uname()[1]
+            for path in ('/etc/machine-id', '/var/lib/dbus/machine-id'):
+                try:
+                    f = open(self.path(path), 'r')
+                    machine_id = f.read().strip()
+                    f.close()
+                    break
+                except IOError:
+                    continue
+            self.splay = self.auth + machine_id
+        return self.splay
+    
+    def splay_jitter(self, interval):
+        """ Up to splay_jitter seconds at random, no more than half of interval """
+        import random
+        return random.uniform(0, min(float(self.config.get('splay_jitter', 0)), interval / 2))
+    
+    def next_slot(self, now, interval):
+        """ When something run every interval seconds is next due: this host's splay_offset into the interval, plus jitter
+        
+        With splay = 0 it is due interval seconds from now, on every host alike.
+        """
+        if self.config.get('splay', '1') != '1':
+            return now + interval
+        return now + (splay_offset(self.splay_key(), interval) - now) % interval + self.splay_jitter(interval)
+    
+    def relay(self):
+        """ Accept agent posts on relay_listen and forward them to relay_upstream in gzipped batches
+        
+        Posts are answered with the upstream status once forwarded, with 202 when relay_wait seconds
+        pass first, which agents do not take as delivered, or with 503 once relay_queue_size bytes wait,
+        which agents spool and resend later. relay_connections threads forward, each over its own
+        kept-alive connection, up to relay_batch posts per request, one per line.
+        """
+        import threading
+        # post_url takes one post per request, batches there would be refused or lost
+        if not self.config.get('relay_upstream'):
+            print("Error: relay_upstream is not set, the relay needs a batch endpoint to forward to")
+            sys.exit(1)
+        try:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+            from SocketServer import ThreadingMixIn
+        except ImportError:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+            from socketserver import ThreadingMixIn
+        agent = self
+        
+        class RelayHandler(BaseHTTPRequestHandler):
+            # Agents in daemon mode keep their connection
+            protocol_version = 'HTTP/1.1'
+            
+            def do_POST(self):
+                import zlib
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                entry = agent.relay_enqueue(body)
+                status = agent.relay_wait(entry) if entry is not None else None
+                if entry is None:
+                    self.send_response(503)
+                    self.send_header('Retry-After', '60')
+                    reply = b'relay queue full'
+                elif status is None:
+                    self.send_response(202)
+                    reply = b'queued'
+                elif 200 <= status < 300:
+                    self.send_response(200)
+                    reply = b'forwarded'
+                else:
+                    self.send_response(status)
+                    reply = b'refused upstream'
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        class RelayServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+            # Agents posting at the same second would overflow the default backlog of 5
+            request_queue_size = 128
+        
+        self.relay_queue = list()
+        self.relay_queued = 0
+        self.relay_cond = threading.Condition()
+        for i in range(int(self.config.get('relay_connections', 2))):
+            thread = threading.Thread(target=self.relay_forward)
+            thread.daemon = True
+            thread.start()
+        host, port = self.config.get('relay_listen', RELAY_LISTEN).rsplit(':', 1)
+        self.relay_server = RelayServer((host, int(port)), RelayHandler)
+        self.relay_server.serve_forever()
+    
+    def query(self):
+        """ Answer local tools on the query_socket Unix socket over HTTP, from what the last posts held
+        
+        GET /metrics answers in the Prometheus text format, /snapshot with the last post and /history
+        with the query_history last posts as JSON. update_query builds every answer once per post,
+        so a request only writes out a buffer.
+        """
+        import threading
+        from collections import deque
+        try:
+            from BaseHTTPServer import BaseHTTPRequestHandler
+            from SocketServer import ThreadingMixIn, UnixStreamServer
+        except ImportError:
+            from http.server import BaseHTTPRequestHandler
+            from socketserver import ThreadingMixIn, UnixStreamServer
+        agent = self
+        
+        class QueryHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                buffers = agent.query_buffers
+                if not buffers:
+                    self.send_response(503)
+                    content_type, body = 'text/plain', b'no post yet'
+                elif self.path.split('?')[0] in buffers:
+                    self.send_response(200)
+                    content_type, body = buffers[self.path.split('?')[0]]
+                else:
+                    self.send_response(404)
+                    content_type, body = 'text/plain', b'try /metrics, /snapshot or /history'
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def address_string(self):
+                # Unix socket peers have no address
+                return 'local'
+            
+            def log_message(self, format, *args):
+                pass
+        
+        class QueryServer(ThreadingMixIn, UnixStreamServer):
+            daemon_threads = True
+        
+        path = os.path.join(self.ttagent_dir, self.config.get('query_socket', 'tt-agent.sock'))
+        if os.path.exists(path):
+            # Left by a daemon that died, we hold the pidfile lock
+            os.remove(path)
+        self.query_history = deque(maxlen=int(self.config.get('query_history', QUERY_HISTORY)))
+        self.query_buffers = {}
+        # Never reachable with wider permissions than query_socket_mode, not even before the chmod
+        umask = os.umask(0o177)
+        try:
+            server = QueryServer(path, QueryHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, int(self.config.get('query_socket_mode', '600'), 8))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    
+    def update_query(self):
+        """ Rebuild the query socket's answers from the post just encoded """
+        import json
+        snapshot = {'time': self.time,
+                    'fields': dict((name, getattr(self, name)) for name in POST_ATTRIBUTES),
+                    'tagged': dict([field.split('=', 1) for field in self.data_post_plain[POST_FIELDS:]])}
+        snapshot_json = json.dumps(snapshot, sort_keys=True)
+        self.query_history.append(snapshot_json)
+        # Swapped in whole, handler threads see the old or the new answers
+        self.query_buffers = {'/metrics': ('text/plain; version=0.0.4; charset=utf-8', self.query_metrics(snapshot['tagged']).encode('utf8')),
+                              '/snapshot': ('application/json', snapshot_json.encode('utf8')),
+                              '/history': ('application/json', ('[' + ','.join(self.query_history) + ']').encode('utf8'))}
+    
+    def query_metrics(self, tagged):
+        """ The last post in the Prometheus text exposition format """
+        lines = list()
+        
+        def metric(name, kind, description, samples):
+            if not samples:
+                return
+            lines.append('# HELP tt_{0} {1}'.format(name, description))
+            lines.append('# TYPE tt_{0} {1}'.format(name, kind))
+            for labels, value in samples:
+                labels = ','.join(['{0}="{1}"'.format(label, str(text).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                                   for label, text in labels])
+                lines.append('tt_{0}{1} {2}'.format(name, '{' + labels + '}' if labels else '', float(value)))
+        
+        metric('agent_info', 'gauge', 'Agent version and host', [((('version', self.version), ('os', self.os_name), ('kernel', self.os_kernel)), 1)])
+        metric('degraded', 'gauge', 'Whether the governor reduced collectors for the last post', [((), 'degraded' in tagged)])
+        metric('uptime_seconds', 'gauge', 'Seconds since boot', [((), self.uptime)])
+        metric('sessions', 'gauge', 'Logged in users', [((), self.sessions)])
+        metric('processes', 'gauge', 'Processes running', [((), self.processes)])
+        metric('open_files', 'gauge', 'Allocated file handles', [((), self.filehandles)])
+        metric('open_files_limit', 'gauge', 'Most file handles the kernel allocates', [((), self.filehandles_limit)])
+        metric('memory_total_bytes', 'gauge', 'Memory, or the container limit', [((), self.ram_total)])
+        metric('memory_used_bytes', 'gauge', 'Memory used, page cache and buffers left out', [((), self.ram_usage)])
+        metric('swap_total_bytes', 'gauge', 'Swap space', [((), self.swap_total)])
+        metric('swap_used_bytes', 'gauge', 'Swap space used', [((), self.swap_usage)])
+        if self.meminfo is not None:
+            metric('memory_available_bytes', 'gauge', 'Memory the kernel could hand out without swapping', [((), self.meminfo[MEMINFO_FIELDS.index('MemAvailable:')] * 1024)])
+            metric('memory_reclaimable_slab_bytes', 'gauge', 'Slab memory the kernel can reclaim', [((), self.meminfo[MEMINFO_FIELDS.index('SReclaimable:')] * 1024)])
+        metric('vmstat_events_per_second', 'gauge', 'Paging and page scan events per second since the previous post',
+               [((('event', name),), rate) for name, rate in self.vmstat_rates or () if name != 'oom_kill'])
+        metric('oom_kills', 'gauge', 'Processes the OOM killer killed since the previous post',
+               [((), rate) for name, rate in self.vmstat_rates or () if name == 'oom_kill'])
+        if self.pressure is not None:
+            stalls = [(resource, kind) for resource in PSI_RESOURCES for kind in PSI_KINDS]
+            for name, offset, description in (('avg10', 0, 'over 10 seconds'), ('avg60', 1, 'over 60 seconds'), ('avg300', 2, 'over 300 seconds')):
+                metric('pressure_' + name + '_percent', 'gauge', 'Share of the time tasks stalled on a resource ' + description,
+                       [((('resource', resource), ('kind', kind)), self.pressure[pos*4+offset]) for pos, (resource, kind) in enumerate(stalls)])
+            metric('pressure_stalled_seconds_total', 'counter', 'Seconds tasks stalled on a resource since boot',
+                   [((('resource', resource), ('kind', kind)), self.pressure[pos*4+3] / 1000000.0) for pos, (resource, kind) in enumerate(stalls)])
+        disks = [disk.split() for disk in self.disk_array.split(';') if disk.strip()]
+        metric('filesystem_size_bytes', 'gauge', 'Size of the filesystem on a device', [((('device', disk[0]),), disk[1]) for disk in disks])
+        metric('filesystem_used_bytes', 'gauge', 'Space used on the filesystem on a device', [((('device', disk[0]),), disk[2]) for disk in disks])
+        metric('connections', 'gauge', 'Open tcp and udp connections', [((), self.connections)])
+        metric('network_receive_bytes_total', 'counter', 'Bytes received on the main interface', [((('nic', self.nic),), self.rx)])
+        metric('network_transmit_bytes_total', 'counter', 'Bytes sent on the main interface', [((('nic', self.nic),), self.tx)])
+        for name, pos, description in (('receive_bytes_per_second', 1, 'Bytes received per second'), ('transmit_bytes_per_second', 2, 'Bytes sent per second'),
+                                       ('receive_packets_per_second', 3, 'Packets received per second'), ('transmit_packets_per_second', 4, 'Packets sent per second'),
+                                       ('errors', 5, 'Receive and transmit errors'), ('drops', 6, 'Receive and transmit drops')):
+            metric('network_' + name, 'gauge', description + ' since the previous post', [((('nic', rate[0]),), rate[pos]) for rate in self.nic_rates or ()])
+        for name, pos, description in (('reads_per_second', 1, 'Reads completed per second'), ('writes_per_second', 2, 'Writes completed per second'),
+                                       ('read_bytes_per_second', 3, 'Bytes read per second'), ('write_bytes_per_second', 4, 'Bytes written per second'),
+                                       ('await_milliseconds', 5, 'Average ms from queueing to completion of a request'),
+                                       ('utilisation_percent', 6, 'Share of the time the device was busy')):
+            metric('disk_' + name, 'gauge', description + ' since the previous post', [((('device', rate[0]),), rate[pos]) for rate in self.disk_rates or ()])
+        metric('load', 'gauge', 'Load average', [((('minutes', minutes),), load) for minutes, load in zip(('1', '5', '15'), self.load.split())])
+        metric('cpu_busy_percent', 'gauge', 'Cpu busy since the previous post', [((), self.load_cpu)])
+        metric('cpu_iowait_percent', 'gauge', 'Share of idle cpu waiting on io since the previous post', [((), self.load_io)])
+        metric('cpu_mode_percent', 'gauge', 'Cpu time per mode since the previous post',
+               [((('mode', category),), share) for category, share in zip(CPU_CATEGORIES, self.cpu_breakdown or ())])
+        metric('cpu_core_busy_percent', 'gauge', 'Busy per online cpu since the previous post', [((('cpu', cpu),), busy) for cpu, busy in self.cpu_cores_busy or ()])
+        # latency holds min, avg, max, mdev and loss per latency_targets entry that answered
+        for name, pos, description in (('latency_milliseconds', 1, 'Average round trip to a latency target, 0 when every probe failed'),
+                                       ('latency_min_milliseconds', 0, 'Shortest round trip to a latency target, 0 when every probe failed'),
+                                       ('latency_max_milliseconds', 2, 'Longest round trip to a latency target, 0 when every probe failed'),
+                                       ('latency_deviation_milliseconds', 3, 'Mean deviation of the round trips to a latency target, 0 when every probe failed')):
+            metric(name, 'gauge', description, [((('target', target),), self.latency.get(target, ('0',) * 5)[pos]) for target in self.latency_targets])
+        metric('latency_loss_percent', 'gauge', 'Share of the probes to a latency target that got no answer',
+               [((('target', target),), self.latency.get(target, ('0',) * 4 + ('100',))[4]) for target in self.latency_targets])
+        for name, pos, description in (('cpu_percent', 0, 'Cpu of a busy cgroup, in percent of one cpu'), ('memory_bytes', 1, 'Memory of a busy cgroup'),
+                                       ('read_bytes_per_second', 2, 'Bytes a busy cgroup read per second'),
+                                       ('write_bytes_per_second', 3, 'Bytes a busy cgroup wrote per second')):
+            metric('cgroup_' + name, 'gauge', description, [((('cgroup', path),), usage[pos]) for path, usage in self.cgroups or ()])
+        lines.append('')
+        return '\n'.join(lines)
+    
+    def relay_enqueue(self, post):
+        """ Queue an agent post for upstream as a [post, upstream status] entry, None when the queue is full """
+        # Live posts carry no time, the backend would take the time they are forwarded for the sample's
+        if b'&time=' not in post:
+            post += '&time={0}'.format(int(time.time())).encode('ascii')
+        entry = [post, None]
+        self.relay_cond.acquire()
+        try:
+            if self.relay_queued + len(post) > int(self.config.get('relay_queue_size', RELAY_QUEUE_SIZE)):
+                return None
+            self.relay_queue.append(entry)
+            self.relay_queued += len(post)
+            self.relay_cond.notify_all()
+            return entry
+        finally:
+            self.relay_cond.release()
+    
+    def relay_wait(self, entry):
+        """ Upstream status of a queued post, None if it is still queued after relay_wait seconds """
+        deadline = time.time() + float(self.config.get('relay_wait', RELAY_WAIT))
+        self.relay_cond.acquire()
+        try:
+            while entry[1] is None and time.time() < deadline:
+                self.relay_cond.wait(deadline - time.time())
+            return entry[1]
+        finally:
+            self.relay_cond.release()
+    
+    def relay_forward(self):
+        """ Forwarder thread: send batches of queued posts upstream, putting them back when that fails
+        
+        A batch upstream refuses is halved until the posts it refuses are found, only those are dropped.
+        """
+        upstream = self.config['relay_upstream']
+        batch = int(self.config.get('relay_batch', 100))
+        flush = float(self.config.get('relay_flush', 5))
+        timeout = float(self.config.get('post_timeout', 30))
+        conn = None
+        failures = 0
+        while True:
+            self.relay_cond.acquire()
+            try:
+                while not self.relay_queue:
+                    self.relay_cond.wait()
+                # Give a batch relay_flush seconds to fill up
+                flush_at = time.time() + flush
+                while len(self.relay_queue) < batch and time.time() < flush_at:
+                    self.relay_cond.wait(flush_at - time.time())
+                posts = self.relay_queue[:batch]
+                del self.relay_queue[:batch]
+            finally:
+                self.relay_cond.release()
+            if not posts:
+                # Another forwarder took them
+                continue
+            batches = [posts]
+            while batches:
+                posts = batches.pop(0)
+                conn, status = self.post_batch(conn, upstream, [entry[0] for entry in posts], time.time() + timeout)
+                if 300 <= status < 500 and len(posts) > 1:
+                    batches[0:0] = [posts[:len(posts) // 2], posts[len(posts) // 2:]]
+                    continue
+                self.relay_cond.acquire()
+                try:
+                    if status == 0 or status >= 500:
+                        # Back at the head of the queue with the batches not sent yet, whatever the queue size,
+                        # they were accepted already
+                        self.relay_queue[0:0] = posts + [entry for rest in batches for entry in rest]
+                        failures += 1
+                        break
+                    if status >= 300:
+                        print("Error: {0} refused a post: HTTP {1}".format(upstream, status))
+                    for entry in posts:
+                        entry[1] = status
+                    self.relay_queued -= sum([len(entry[0]) for entry in posts])
+                    self.relay_cond.notify_all()
+                    failures = 0
+                finally:
+                    self.relay_cond.release()
+            if failures:
+                time.sleep(min(2 ** failures, 60))
+            sys.stdout.flush()
+    
+    def post_batch(self, conn, url, posts, deadline):
+        """ POST posts to a batch endpoint, gzipped one per line, returns (conn, status) with status 0 when the request failed """
+        headers = {'Content-Type': 'application/x-tt-batch',
+                   'Content-Encoding': 'gzip',
+                   'X-TT-Batch': str(len(posts))}
+        try:
+            conn, status, reply = self.http_post(conn, url, self.gzip(b'\n'.join(posts)), headers, deadline)
+        except IOError as e:
+            print("Error: Posting a batch to {0} failed: {1}".format(url, e))
+            return None, 0
+        return conn, status
+    
+    def path(self, path):
+        if self.root == '/':
+            return path
+        return self.root.rstrip('/') + path
+    
+    def govern(self, cpu_limit=False):
+        """ Run at idle cpu and io priority so the host's own work always comes first
+        
+        With cpu_limit, as for cron runs, the kernel also ends a run that uses more than
+        governor_cpu_limit cpu seconds, whatever it is stuck in.
+        """
+        if self.config.get('governor', '1') != '1':
+            return
+        try:
+            os.nice(max(int(self.config.get('governor_nice', 19)) - os.nice(0), 0))
+        except OSError:
+            pass
+        if self.config.get('governor_ionice', '1') == '1':
+            # Left at the default priority where the syscall is unknown or refused, saying so every cron
+            # run would mail the admin every CRON_PERIOD
+            self.set_ioprio_idle()
+        if cpu_limit:
+            import resource
+            limit = int(self.config.get('governor_cpu_limit', 60))
+            soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            if hard != resource.RLIM_INFINITY:
+                limit = min(limit, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+    
+    def set_ioprio_idle(self):
+        """ ioprio_set(IOPRIO_WHO_PROCESS, ourselves, IOPRIO_CLASS_IDLE), threads started later inherit it """
+        import ctypes
+        number = IOPRIO_SET.get(os.uname()[4])
+        if number is None:
+            return False
+        libc = ctypes.CDLL(None, use_errno=True)
+        # The class goes in the top 3 of the 16 bits, the level is unused for the idle class
+        return libc.syscall(number, 1, 0, 3 << 13) == 0
+    
+    def governor_reasons(self):
+        """ Thresholds the host or this run is over, as reason -> value, empty when collectors may run in full """
+        reasons = {}
+        if self.config.get('governor', '1') != '1':
+            return reasons
+        f = open(self.path('/proc/loadavg'), 'r')
+        cpus = self.online_cpus()
+        load = float(f.read().split()[0]) / cpus
+        f.close()
+        if load > float(self.config.get('governor_load', GOVERNOR_LOAD)):
+            reasons['load'] = load
+        psi = float(self.config.get('governor_psi', GOVERNOR_PSI))
+        for resource in ('cpu', 'io', 'memory'):
+            avg10 = self.read_pressure(self.path('/proc/pressure/' + resource))
+            if avg10 is None:
+                # No pressure stall information before Linux 4.20, or with psi=0
+                break
+            if avg10 > psi:
+                reasons['psi_' + resource] = avg10
+        # More processes and connections to read on bigger hosts, and more time to read them in on longer intervals
+        used = cpu_time() - self.governor_cpu_start
+        budget = float(self.config.get('governor_cpu_share', GOVERNOR_CPU_SHARE)) / 100 * float(self.config.get('post_interval', CRON_PERIOD)) * cpus
+        if used > budget:
+            reasons['cpu_budget'] = used
+        # Our own process, also for fixture trees
+        f = open('/proc/self/statm', 'r')
+        rss = float(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+        f.close()
+        if rss > float(self.config.get('governor_memory', GOVERNOR_MEMORY)):
+            reasons['memory'] = rss
+        return reasons
+    
+    def run_collector(self, collector):
+        """ Run a collector, recording wall time, cpu time (ours and our children's) and forks in self.profile
+        
+        Governed collectors run reduced while governor_reasons gives any reason, which the next post lists.
+        """
+        kwargs = {}
+        if collector in GOVERNED_COLLECTORS:
+            reasons = self.governor_reasons()
+            if reasons:
+                self.degraded.update(reasons)
+                if collector not in self.reduced:
+                    self.reduced.append(collector)
+                kwargs['reduced'] = True
+        start_forks = forks
+        start_cpu = cpu_time()
+        start_wall = time.time()
+        try:
+            getattr(self, collector)(**kwargs)
+        finally:
+            self.profile[collector] = {'wall': (time.time() - start_wall) * 1000,
+                                       'cpu': (cpu_time() - start_cpu) * 1000,
+                                       'forks': forks - start_forks}
+    
+    def profile_table(self):
+        lines = ['{0:<24}{1:>10}{2:>10}{3:>7}'.format('collector', 'wall ms', 'cpu ms', 'forks')]
+        for collector, interval in self.collectors:
+            if collector in self.profile:
+                prof = self.profile[collector]
+                lines.append('{0:<24}{1:>10.2f}{2:>10.2f}{3:>7}'.format(collector, prof['wall'], prof['cpu'], prof['forks']))
+        lines.append('{0:<24}{1:>10.2f}{2:>10.2f}{3:>7}'.format('total',
+                                                               sum([prof['wall'] for prof in self.profile.values()]),
+                                                               sum([prof['cpu'] for prof in self.profile.values()]),
+                                                               sum([prof['forks'] for prof in self.profile.values()])))
+        return '\n'.join(lines)
+    
+    def extra_fields(self):
+        """ Optional fields after the fixed ones, each tagged as 'name=value' """
+        extra = list()
+        if self.config.get('self_metrics') == '1':
+            extra.append('profile=' + self.profile_field())
+        if self.cpu_breakdown is not None:
+            extra.append('cpu=' + ';'.join(['{0}:{1:.1f}'.format(category, share) for category, share in zip(CPU_CATEGORIES, self.cpu_breakdown)]))
+        if self.cpu_cores_busy:
+            extra.append('cores=' + ';'.join(['{0}:{1:.1f}'.format(cpu, busy) for cpu, busy in self.cpu_cores_busy]))
+        if self.tcp_states is not None:
+            states = ['{0}:{1}'.format(name, self.tcp_states[name]) for state, name in TCP_STATES if self.tcp_states[name]]
+            extra.append('sockets=' + ';'.join(states + ['UDP:{0}'.format(self.udp_sockets)]))
+        if self.processes_io is not None:
+            # Totals over every process, and io per processes_array entry in the same order
+            extra.append('proctotal=cpu:{0};rss:{1}'.format(self.format_pcpu(self.processes_cpu), self.processes_rss))
+            extra.append('procio=' + ';'.join(['-' if rate is None else '{0:.0f}/{1:.0f}'.format(*rate) for rate in self.processes_io]))
+        if self.cgroups:
+            # 'path:cpu%/memory/read_Bps/write_Bps/cpu_psi/memory_psi/io_psi', the root cgroup is the host totals
+            extra.append('cgroups=' + ';'.join(['{0}:{1:.1f}/{2}/{3:.0f}/{4:.0f}/{5:.1f}/{6:.1f}/{7:.1f}'.format(self.escape_cgroup(path), *usage)
+                                                for path, usage in self.cgroups]))
+        if self.cgroup_limits:
+            extra.append('limits=' + ';'.join(['{0}:{1}'.format(name, limit) for name, limit in self.cgroup_limits]))
+        if self.disks_stale:
+            # Mount points as escaped in mountinfo, they hold no whitespace
+            extra.append('stale=' + ','.join(self.disks_stale))
+        if self.nic_rates:
+            # Every interface, not just nic: 'nic:rx_Bps/tx_Bps/rx_pps/tx_pps/errors/drops'
+            extra.append('nics=' + ';'.join(['{0}:{1:.0f}/{2:.0f}/{3:.0f}/{4:.0f}/{5}/{6}'.format(*rate) for rate in self.nic_rates]))
+        if self.disk_rates:
+            # Devices with io since the previous post: 'device:reads/s/writes/s/read_Bps/write_Bps/await_ms/util%'
+            extra.append('diskio=' + ';'.join(['{0}:{1:.1f}/{2:.1f}/{3:.0f}/{4:.0f}/{5:.2f}/{6:.1f}'.format(*rate) for rate in self.disk_rates]))
+        if self.meminfo is not None:
+            # Bytes the kernel could hand out without swapping, of reclaimable slab, and dirty or under writeback
+            extra.append('mem=' + ';'.join(['{0}:{1:.0f}'.format(name, self.meminfo[MEMINFO_FIELDS.index(field)] * 1024) for name, field in
+                                            (('available', 'MemAvailable:'), ('reclaimable', 'SReclaimable:'), ('dirty', 'Dirty:'), ('writeback', 'Writeback:'))]))
+        if self.vmstat_rates:
+            # Events per second since the previous post, oom_kill the OOM kills since
+            extra.append('vmstat=' + ';'.join(['{0}:{1:.0f}'.format(name, rate) if name == 'oom_kill' else '{0}:{1:.1f}'.format(name, rate)
+                                               for name, rate in self.vmstat_rates]))
+        if self.pressure is not None:
+            # 'resource_kind:avg10/avg60/avg300/stalled%/total_us', stalled since the previous post or '-' before it
+            stalls = ['{0}_{1}'.format(resource, kind) for resource in PSI_RESOURCES for kind in PSI_KINDS]
+            extra.append('psi=' + ';'.join(['{0}:{1:.2f}/{2:.2f}/{3:.2f}/{4}/{5:.0f}'.format(name, self.pressure[pos*4], self.pressure[pos*4+1], self.pressure[pos*4+2],
+                                                                                          '-' if self.psi_stalled is None else '{0:.2f}'.format(self.psi_stalled[pos]),
+                                                                                          self.pressure[pos*4+3])
+                                            for pos, name in enumerate(stalls)]))
+        if self.latency_targets:
+            # Every configured target: 'name:min/avg/max/mdev/loss%', '-' for the round trips when none answered
+            extra.append('latency=' + ';'.join(['{0}:{1}'.format(target, '/'.join(self.latency.get(target, ('-',) * 4 + ('100',))))
+                                                for target in self.latency_targets]))
+        if self.addresses:
+            extra.append('addrs=' + ';'.join(['{0}:{1}'.format(nic, ','.join(addrs)) for nic, addrs in sorted(self.addresses.items()) if nic != 'lo']))
+        if self.samples.count > 0:
+            extra.append('window=' + self.window_field())
+        if self.reduced:
+            # Why the governor reduced collectors since the previous post, and which: 'load:3.2;psi_io:61.0;reduced:calc_processes'
+            reasons = ['{0}:{1:.1f}'.format(reason, value) for reason, value in sorted(self.degraded.items())]
+            extra.append('degraded=' + ';'.join(reasons + ['reduced:' + ','.join(self.reduced)]))
+        return extra
+    
+    def profile_field(self):
+        """ Self-metrics payload field: 'collector:wall_ms:cpu_ms:forks;...' """
+        fields = ['{0}:{1:.1f}:{2:.1f}:{3}'.format(collector, self.profile[collector]['wall'], self.profile[collector]['cpu'], self.profile[collector]['forks'])
+                  for collector, interval in self.collectors if collector in self.profile]
+        return ';'.join(fields)
+    
+    def write_profile(self):
+        import json
+        profile = {'time': int(time.time()), 'version': self.version, 'collectors': self.profile}
+        profilelog = open(self.profilelog, 'w')
+        json.dump(profile, profilelog, sort_keys=True)
+        profilelog.close()
+    
     def calc_uptime(self):
-        f = open('/proc/uptime', 'r')
+        self.uptime = self.read_uptime()
+    
+    def read_uptime(self):
+        f = open(self.path('/proc/uptime'), 'r')
         up = float(f.readline().split()[0])
         f.close()
-        self.uptime = up
+        return up
     
     def calc_sessions(self):
+        utmp = self.use_caps()['paths']['calc_sessions']
+        if utmp != 'who':
+            self.sessions = self.read_utmp_sessions(self.path(utmp))
+            return
         p = check_output('who')
         n_sessions = len(p.splitlines())
         self.sessions = n_sessions
     
-    def calc_processes(self):
+    def read_utmp_sessions(self, utmp):
+        """ Count logged in users straight from utmp, as `who` does """
+        n_sessions = 0
+        f = open(utmp, 'rb')
+        try:
+            while True:
+                record = f.read(UTMP_RECORD_SIZE)
+                if len(record) < UTMP_RECORD_SIZE:
+                    break
+                ut_type = struct.unpack('=h', record[0:2])[0]
+                if ut_type == UTMP_USER_PROCESS and record[44:45] != b'\0':
+                    n_sessions += 1
+        finally:
+            f.close()
+        return n_sessions
+    
+    def calc_processes(self, reduced=False):
+        procfs = self.use_caps()['paths']['calc_processes'] == 'proc'
+        if reduced and procfs:
+            # Just count the processes, without reading their stat, io or owner
+            self.processes = len([pid for pid in os.listdir(self.path('/proc')) if pid.isdigit()])
+            self.processes_array = ''
+            self.processes_io = None
+            return
+        if procfs:
+            uptime = self.read_uptime()
+            top = self.track_processes(uptime)
+            procarray = ['{0} {1} {2} {3}'.format(self.proc_user(proc[2]), self.format_pcpu(proc[0]), proc[1], proc[3]) for proc in top]
+            procarray.append('')
+            self.processes_array = ';'.join(procarray)
+            self.processes_io = self.read_proc_io(top, uptime)
+            return
         p = check_output(['ps','axc'])
         n_processes = len(p.splitlines())
         self.processes = n_processes
         # write the processes_array part here
         p2 = check_output(['ps', 'axc', '-o', 'uname:12,pcpu,rss,cmd', '--sort=-pcpu,-rss', '--noheaders', '--width', '120'])
-        proclist = p2.decode('utf8').splitlines()
+        proclist = p2.splitlines()[:int(self.config.get('top_processes', TOP_PROCESSES))]
         proclistsplit = list()
         for proc in proclist:
             proclistsplit.append(proc.split())
@@ -89,30 +944,335 @@ class TTagent(object):
             procarray.append(' '.join(proc))
         procarray.append('')
         self.processes_array = ';'.join(procarray)
+        self.processes_io = None
+    
+    def track_processes(self, uptime):
+        """ Read every /proc/<pid>/stat once and return the top_processes busiest as (pcpu in tenths, rss kB, pid, comm, start)
+        
+        uptime is read along with the scan, as calc_uptime may run at another interval. pcpu is the share
+        of the interval since the previous call, from the pid, start time and cpu jiffies
+        kept in three sorted arrays. Without a previous call it is the lifetime average, as ps reports it.
+        """
+        import heapq
+        hertz = os.sysconf('SC_CLK_TCK')
+        pagesize_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+        top_processes = int(self.config.get('top_processes', TOP_PROCESSES))
+        self.read_state()
+        if self.proc_prev[0] > uptime:
+            # Uptime went back, the table is from before a reboot
+            self.proc_prev = (0, array('l'), array('d'), array('d'))
+        prev_uptime, prev_pids, prev_starts, prev_cputimes = self.proc_prev
+        elapsed = uptime - prev_uptime
+        pids, starts, cputimes = array('l'), array('d'), array('d')
+        total_pcpu, total_rss = 0, 0
+        top = list()
+        j = 0
+        proc = self.path('/proc/')
+        for pid in sorted([int(pid) for pid in os.listdir(proc) if pid.isdigit()]):
+            try:
+                f = open(proc + str(pid) + '/stat', 'r')
+                stat = f.read()
+                f.close()
+            except (IOError, OSError):
+                # The process exited while we were walking /proc
+                continue
+            comm = stat[stat.find('(')+1:stat.rfind(')')]
+            # Fields after the comm, see proc(5): utime, stime, starttime and rss
+            fields = stat[stat.rfind(')')+2:].split()
+            cputime = float(fields[11]) + float(fields[12])
+            start = float(fields[19])
+            rss = int(fields[21]) * pagesize_kb
+            while j < len(prev_pids) and prev_pids[j] < pid:
+                j += 1
+            if elapsed > 0 and j < len(prev_pids) and prev_pids[j] == pid and prev_starts[j] == start:
+                pcpu = int((cputime - prev_cputimes[j]) * 1000 / hertz / elapsed)
+            else:
+                # New since the previous scan, or no previous scan: average over its lifetime or the interval
+                runtime = uptime - start / hertz
+                if elapsed > 0:
+                    runtime = min(runtime, elapsed)
+                pcpu = int(cputime * 1000 / hertz / runtime) if runtime > 0 else 0
+            pids.append(pid)
+            starts.append(start)
+            cputimes.append(cputime)
+            total_pcpu += pcpu
+            total_rss += rss
+            entry = (pcpu, rss, pid, ' '.join(comm.split()), start)
+            if len(top) < top_processes:
+                heapq.heappush(top, entry)
+            elif entry > top[0]:
+                heapq.heapreplace(top, entry)
+        self.proc_prev = (uptime, pids, starts, cputimes)
+        self.processes = len(pids)
+        self.processes_cpu = total_pcpu
+        self.processes_rss = total_rss
+        return sorted(top, reverse=True)
+    
+    def proc_user(self, pid):
+        """ Owner of pid, as `ps -o uname:12` shows it """
+        import pwd
+        try:
+            uid = os.stat(self.path('/proc/{0}'.format(pid))).st_uid
+        except OSError:
+            return '?'
+        if uid not in self.users:
+            try:
+                self.users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self.users[uid] = str(uid)
+            # ps falls back to the numeric uid when the name does not fit
+            if len(self.users[uid]) > 12:
+                self.users[uid] = str(uid)
+        return self.users[uid]
+    
+    def read_proc_io(self, top, uptime):
+        """ Read and write bytes/s of the top processes at uptime, since the previous call or over their lifetime """
+        hertz = os.sysconf('SC_CLK_TCK')
+        prev_io = self.proc_io_prev
+        self.proc_io_prev = {}
+        rates = list()
+        for pcpu, rss, pid, comm, start in top:
+            try:
+                f = open(self.path('/proc/{0}/io'.format(pid)), 'r')
+                io = dict([line.split(':') for line in f.readlines()])
+                f.close()
+            except (IOError, OSError, ValueError):
+                # Other users' io needs ptrace access, or the process is gone
+                rates.append(None)
+                continue
+            current = (start, uptime, int(io['read_bytes']), int(io['write_bytes']))
+            self.proc_io_prev[pid] = current
+            previous = prev_io.get(pid)
+            if previous is None or previous[0] != start or current[1] <= previous[1]:
+                previous = (start, start / hertz, 0, 0)
+            elapsed = current[1] - previous[1]
+            if elapsed <= 0:
+                rates.append((0, 0))
+                continue
+            rates.append(((current[2] - previous[2]) / elapsed, (current[3] - previous[3]) / elapsed))
+        return rates
+    
+    def format_pcpu(self, pcpu):
+        if pcpu > 999:
+            return str(pcpu // 10)
+        return '{0}.{1}'.format(pcpu // 10, pcpu % 10)
     
     def calc_filehandles(self):
-        f = open('/proc/sys/fs/file-nr','r')
+        f = open(self.path('/proc/sys/fs/file-nr'),'r')
         fl = f.readline()
         f.close()
         self.filehandles = int(fl.split()[0])
         self.filehandles_limit = int(fl.split()[2])
     
+    def use_facts(self, group, detect):
+        """ Set the FACT_GROUPS attributes of group from tt-facts.json while they are valid, otherwise detect() them """
+        if self.facts is None:
+            self.read_facts()
+        validator = self.fact_validator(group)
+        cached = self.facts.get(group)
+        if cached and cached['validator'] == validator and time.time() - cached['time'] < float(self.config.get('facts_ttl', FACTS_TTL)) \
+                and all(attr in cached['facts'] for attr in FACT_GROUPS[group]):
+            for attr in FACT_GROUPS[group]:
+                setattr(self, attr, cached['facts'][attr])
+            return
+        detect()
+        self.facts[group] = {'time': time.time(),
+                             'facts': dict((attr, getattr(self, attr)) for attr in FACT_GROUPS[group])}
+        # Again, the net validator follows the nic just detected
+        self.facts[group]['validator'] = self.fact_validator(group)
+        self.write_facts()
+    
+    def fact_validator(self, group):
+        """ Cheap readings that change whenever the facts of group may have: boot id plus one per group """
+        def read(path):
+            try:
+                f = open(self.path(path), 'r')
+                value = f.read()
+                f.close()
+                return value
+            except IOError:
+                return ''
+        
+        validator = [self.read_boot_id()]
+        if group == 'os':
+            try:
+                validator.append(os.stat(self.path('/etc/os-release')).st_mtime)
+            except OSError:
+                validator.append(0)
+        elif group == 'cpu':
+            validator.append(read('/sys/devices/system/cpu/online'))
+        elif group == 'net':
+            # Routes decide the nic, link flaps on it are when its addresses tend to change
+            nic = self.facts.get('net', {}).get('facts', {}).get('nic', 'N/A')
+            validator.append(read('/proc/net/route'))
+            validator.append(read('/sys/class/net/{0}/carrier_changes'.format(nic)))
+            try:
+                validator.append(sorted(os.listdir(self.path('/sys/class/net'))))
+            except OSError:
+                validator.append([])
+        return validator
+    
+    def read_facts(self):
+        import json
+        self.facts = {}
+        if os.path.isfile(self.factslog):
+            try:
+                factslog = open(self.factslog, 'r')
+                self.facts = json.load(factslog)
+                factslog.close()
+            except ValueError:
+                # Cut short, detect everything again
+                pass
+    
+    def write_facts(self):
+        import json
+        factslog = open(self.factslog + '.tmp', 'w')
+        json.dump(self.facts, factslog)
+        factslog.close()
+        os.rename(self.factslog + '.tmp', self.factslog)
+    
+    def use_caps(self):
+        """ The capability manifest from tt-caps.json, probed and written again once it is missing or stale
+        
+        The daemon checks it again every caps_ttl seconds, for programs installed or removed since.
+        """
+        import json
+        if self.caps is not None and time.time() - self.caps_checked < float(self.config.get('caps_ttl', CAPS_TTL)):
+            return self.caps
+        self.caps_checked = time.time()
+        try:
+            capslog = open(self.capslog, 'r')
+            self.caps = json.load(capslog)
+            capslog.close()
+        except (IOError, ValueError):
+            self.caps = None
+        if self.caps is None or self.caps.get('version') != self.version or self.caps.get('stamp') != self.caps_stamp() \
+                or not all(source in self.caps['sources'] for source in CAPS_SOURCES) or not all(tool in self.caps['tools'] for tool in CAPS_TOOLS):
+            self.write_caps(self.probe_caps())
+        return self.caps
+    
+    def caps_stamp(self):
+        """ Cheap readings that change whenever the manifest may have: program directory mtimes and ping_group_range """
+        stamp = list()
+        for directory in CAPS_DIRS:
+            try:
+                stamp.append([directory, int(os.stat(directory).st_mtime)])
+            except OSError:
+                stamp.append([directory, 0])
+        try:
+            f = open(self.path('/proc/sys/net/ipv4/ping_group_range'), 'r')
+            stamp.append(f.read().split())
+            f.close()
+        except IOError:
+            stamp.append([])
+        return stamp
+    
+    def probe_caps(self):
+        """ Which programs and sources there are, and the fast path each collector takes with them """
+        import socket
+        tools = dict((tool, which(tool)) for tool in CAPS_TOOLS)
+        sources = dict((source, os.path.exists(self.path(source))) for source in CAPS_SOURCES)
+        paths = {}
+        paths['calc_sessions'] = ([utmp for utmp in ('/var/run/utmp', '/run/utmp') if sources[utmp]] + ['who'])[0]
+        paths['calc_processes'] = 'proc' if sources['/proc/self'] else 'ps'
+        paths['calc_hardware'] = 'mountinfo' if sources['/proc/self/mountinfo'] else 'df'
+        paths['calc_connections'] = 'proc' if sources['/proc/net'] else 'ss' if tools['ss'] else 'netstat'
+        paths['calc_cgroups'] = ''
+        for root in (self.config.get('cgroup_root', '/sys/fs/cgroup'), '/sys/fs/cgroup/unified'):
+            if os.path.isfile(self.path(root) + '/cgroup.controllers'):
+                paths['calc_cgroups'] = root
+                break
+        try:
+            # Unprivileged ICMP needs our group in net.ipv4.ping_group_range
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+            paths['get_network_latency'] = 'icmp'
+        except socket.error:
+            paths['get_network_latency'] = 'ping'
+        return {'version': self.version,
+                'stamp': self.caps_stamp(),
+                'tools': tools,
+                'sources': sources,
+                'paths': paths}
+    
+    def write_caps(self, caps):
+        import json
+        self.caps = caps
+        capslog = open(self.capslog + '.tmp', 'w')
+        json.dump(caps, capslog, indent=1, sort_keys=True)
+        capslog.close()
+        os.rename(self.capslog + '.tmp', self.capslog)
+    
     def identify_os(self):
-        self.os_kernel = platform.release()
-        if platform.system() == 'Linux' and platform.linux_distribution()[0] != '':
-            self.os_name = ' '.join(platform.linux_distribution()[0:2])
+        self.use_facts('os', self.detect_os)
+    
+    def detect_os(self):
+        sysname, nodename, self.os_kernel, version, self.machine = os.uname()
+        os_release = self.read_os_release()
+        if sysname == 'Linux' and 'NAME' in os_release:
+            self.os_name = ' '.join([os_release[key] for key in ('NAME', 'VERSION_ID') if key in os_release])
         else:
-            self.os_name = platform.system()
-        self.machine = platform.machine()
+            self.os_name = sysname
         if self.machine == 'x86_64':
             self.os_arch = 'x64'
         elif self.machine[0] == 'i' and self.machine[-2:] == '86':
             self.os_arch = 'x86'
         else:
-            self.os_arch = platform.machine()
+            self.os_arch = self.machine
+    
+    def read_os_release(self):
+        """ KEY=value pairs of os-release(5), quotes and backslash escapes taken off the values """
+        for path in ('/etc/os-release', '/usr/lib/os-release'):
+            try:
+                f = open(self.path(path), 'r')
+            except IOError:
+                continue
+            os_release = {}
+            for line in f.readlines():
+                line = line.strip()
+                if '=' not in line or line.startswith('#'):
+                    continue
+                key, value = line.split('=', 1)
+                if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+                    value = value[1:-1]
+                os_release[key] = value.replace('\\"', '"').replace('\\$', '$').replace('\\`', '`').replace('\\\\', '\\')
+            f.close()
+            return os_release
+        return {}
     
     def calc_hardware(self):
-        f = open('/proc/cpuinfo','r')
+        self.use_facts('cpu', self.detect_cpu)
+        # RAM and Swap units in meminfo are in kB. We'll convert to Bytes later
+        meminfo = self.read_meminfo()
+        self.ram_total, ram_free, ram_buffers, ram_cached, self.swap_total, swap_free = [int(val) for val in meminfo[0:6]]
+        self.ram_usage = self.ram_total-(ram_free+ram_cached+ram_buffers)
+        # Convert from kB to B
+        self.ram_usage = self.ram_usage * 1024
+        self.ram_total = self.ram_total * 1024
+        # Now swap
+        self.swap_usage = self.swap_total - swap_free
+        # Convert kB to B
+        self.swap_usage = self.swap_usage * 1024
+        self.swap_total = self.swap_total * 1024
+        self.read_cgroup_limits()
+        # Disk space
+        if self.use_caps()['paths']['calc_hardware'] == 'mountinfo':
+            disks = self.read_mounts_usage()
+        else:
+            df = check_output(['df', '-P', '-B', '1'])
+            disks = [disk.split() for disk in df.split('\n')]
+            disks.remove([])
+            disks = [disk for disk in disks if disk[0][0]=='/']
+        disktotvals = [disk[1] for disk in disks]
+        self.disk_total = '+'.join(disktotvals)
+        diskusevals = [disk[2] for disk in disks]
+        self.disk_usage = '+'.join(diskusevals)
+        disk_arr = [disk[0:3] for disk in disks]
+        disk_arr_txt = [' '.join(disk_arr_itm) for disk_arr_itm in disk_arr]
+        disk_arr_txt.append('')
+        self.disk_array = '; '.join(disk_arr_txt).strip()
+    
+    def detect_cpu(self):
+        f = open(self.path('/proc/cpuinfo'),'r')
         flines = f.readlines()
         f.close()
         cpu_cores_list = [line.split('\t: ')[1].strip() for line in flines if 'model name' in line]
@@ -130,6 +1290,8 @@ class TTagent(object):
             self.cpu_freq = [line.split('\t: ')[1].strip() for line in flines if 'cpu MHz' in line][0]
         except:
             try:
+                if not self.use_caps()['tools']['lscpu']:
+                    raise OSError('no lscpu')
                 p = check_output(['lscpu'])
                 p = p.split('\n')
                 plines = [line.split() for line in p]
@@ -137,86 +1299,158 @@ class TTagent(object):
                 self.cpu_freq = [line[2] for line in plines if line[0]=='CPU' and line[1]=='MHz:'][0]
             except:
                 self.cpu_freq = ''
-        # RAM and Swap units in meminfo are in kB. We'll convert to Bytes later
-        meminf  = open('/proc/meminfo','r')
-        meminftext = meminf.readlines()
-        meminf.close()
-        meminfo = [line.split() for line in meminftext]
-        self.ram_total = int([line[1] for line in meminfo if line[0]=='MemTotal:'][0])
-        ram_free = int([line[1] for line in meminfo if line[0]=='MemFree:'][0])
-        ram_cached = int([line[1] for line in meminfo if line[0]=='Cached:'][0])
-        ram_buffers = int([line[1] for line in meminfo if line[0]=='Buffers:'][0])
-        self.ram_usage = self.ram_total-(ram_free+ram_cached+ram_buffers)
-        # Convert from kB to B
-        self.ram_usage = self.ram_usage * 1024
-        self.ram_total = self.ram_total * 1024
-        # Now swap
-        self.swap_total = int([line[1] for line in meminfo if line[0]=='SwapTotal:'][0])
-        swap_free = int([line[1] for line in meminfo if line[0]=='SwapFree:'][0])
-        self.swap_usage = self.swap_total - swap_free
-        # Convert kB to B
-        self.swap_usage = self.swap_usage * 1024
-        self.swap_total = self.swap_total * 1024
-        # Disk space
-        df = check_output(['df', '-P', '-B', '1'])
-        disks = [disk.split() for disk in df.split('\n')]
-        disks.remove([])
-        disktotvals = [disk[1] for disk in disks if disk[0][0]=='/']
-        self.disk_total = '+'.join(disktotvals)
-        diskusevals = [disk[2] for disk in disks if disk[0][0]=='/']
-        self.disk_usage = '+'.join(diskusevals)
-        disk_arr = [disk[0:3] for disk in disks if disk[0][0]=='/']
-        disk_arr_txt = [' '.join(disk_arr_itm) for disk_arr_itm in disk_arr]
-        disk_arr_txt.append('')
-        self.disk_array = '; '.join(disk_arr_txt).strip()
     
-    def calc_connections(self):
-        try:
-            subprocess.check_call(['command','-v','ss'],shell=True)
-            connections = check_output(['ss', '-tun']).split('\n')[1:]
-        except:
-            connections = check_output(['netstat', '-tun']).split('\n')[2:]
-        connections.remove('')
-        self.connections = len(connections)
-        try:
-            irout = check_output(['ip', 'route', 'get', '8.8.8.8']).split()
-            devidx = irout.index('dev')+1
-            self.nic = irout[devidx]
-        except:
-            try:
-                irout = check_output(['ip','link','show']).split('\n')
-                irout.remove('')
-                iroutarr = [rout.split() for rout in irout]
-                self.nic = [rout[1][:-1] for rout in iroutarr if 'eth' in rout[1][0:3]][0]
-            except:
-                self.nic = 'N/A'
-        # IPv4 address
+    def read_mountinfo(self):
+        """ (source, mount point, fs type, device, root, mount id) per mount in /proc/self/mountinfo, after the disk_* filters """
+        f = open(self.path('/proc/self/mountinfo'), 'r')
+        lines = [line.split() for line in f.readlines()]
+        f.close()
+        network = self.config.get('disk_network') == '1'
+        bind_mounts = self.config.get('disk_bind_mounts', '1') == '1'
+        dedup = self.config.get('disk_dedup', '1') == '1'
+        excluded = [fstype.strip() for fstype in self.config.get('disk_fstypes_exclude', '').split(',') if fstype.strip()]
+        mounts = list()
+        seen_devs = set()
+        for line in lines:
+            # id parent major:minor root mountpoint options [optional...] - fstype source superoptions
+            sep = line.index('-', 6)
+            root, mountpoint, device = line[3], line[4], line[2]
+            fstype, source = line[sep+1], line[sep+2]
+            if fstype in excluded:
+                continue
+            # Block devices as df lists them, and when asked network and fuse filesystems
+            if source[0] != '/' and not (network and (fstype in NETWORK_FSTYPES or fstype.startswith('fuse.'))):
+                continue
+            # Mounts of a subdirectory are bind mounts
+            if not bind_mounts and root != '/':
+                continue
+            if dedup and device in seen_devs:
+                continue
+            seen_devs.add(device)
+            mounts.append((source, mountpoint, fstype, device, root, line[0]))
+        return mounts
+    
+    def read_mounts_usage(self):
+        """ [device, total, used] in bytes per mount, as `df -P -B 1`, with statvfs in a pool of threads
+        
+        A mount whose statvfs misses disk_timeout, e.g. a stale NFS server, is left out and listed in
+        self.disks_stale. Its thread is left behind and the mount skipped until that statvfs returns.
+        Mounts are told apart by mount id, with disk_dedup = 0 several can share a mount point.
+        """
+        import threading
+        from collections import deque
+        mounts = self.read_mountinfo()
+        timeout = float(self.config.get('disk_timeout', 2))
+        stale = set([mount[5] for mount in mounts if mount[5] in self.disks_stuck])
+        queue = deque([mount for mount in mounts if mount[5] not in stale])
+        results = {}
+        running = {}
+        cond = threading.Condition()
+        
+        def worker():
+            while True:
+                cond.acquire()
+                try:
+                    if not queue:
+                        return
+                    mount = queue.popleft()
+                    mountpoint, mount_id = mount[1], mount[5]
+                    running[mount_id] = (time.time(), threading.current_thread())
+                finally:
+                    cond.release()
+                # Whitespace in mount points is octal escaped, e.g. '\040'
+                path = self.path(mountpoint.replace('\\040', ' ').replace('\\011', '\t').replace('\\134', '\\'))
+                try:
+                    vfs = os.statvfs(path)
+                except OSError:
+                    vfs = None
+                cond.acquire()
+                try:
+                    if mount_id in self.disks_stuck:
+                        # Given up on and replaced, this thread is done
+                        self.disks_stuck.discard(mount_id)
+                        return
+                    del running[mount_id]
+                    results[mount_id] = vfs
+                    cond.notify()
+                finally:
+                    cond.release()
+        
+        def start_worker():
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        
+        threads = list()
+        stuck_threads = set()
+        
+        cond.acquire()
         try:
-            ipinfo = check_output(['ip','addr','show',self.nic]).split("inet ")[1].split("/")[0]
-            ipv4 = ipinfo.strip()
-            if ipv4 == '127.0.0.1':
-                ipinfo = check_output(['ip','addr','show',self.nic]).split("inet ")[2].split("/")[0]
-                ipv4 = ipinfo.strip()
-                self.ipv4 = ipv4.strip()
+            for i in range(min(int(self.config.get('disk_workers', 4)), len(queue))):
+                start_worker()
+            while queue or running:
+                now = time.time()
+                for mount_id, (started, thread) in list(running.items()):
+                    if now - started >= timeout:
+                        del running[mount_id]
+                        stuck_threads.add(thread)
+                        stale.add(mount_id)
+                        self.disks_stuck.add(mount_id)
+                        if queue:
+                            start_worker()
+                if queue or running:
+                    # Woken by every finished statvfs, or when the oldest one running is due
+                    cond.wait(max(min([started for started, thread in running.values()] or [now]) + timeout - now, 0.01))
+        finally:
+            cond.release()
+        # The others are only left to see the empty queue
+        for thread in threads:
+            if thread not in stuck_threads:
+                thread.join()
+        
+        disks = list()
+        self.disks_stale = list()
+        for source, mountpoint, fstype, device, root, mount_id in mounts:
+            if mount_id in stale:
+                self.disks_stale.append(mountpoint)
+                continue
+            vfs = results.get(mount_id)
+            # df leaves out empty pseudo filesystems
+            if vfs is None or vfs.f_blocks == 0:
+                continue
+            total = vfs.f_blocks * vfs.f_frsize
+            used = (vfs.f_blocks - vfs.f_bfree) * vfs.f_frsize
+            disks.append([source, str(total), str(used)])
+        return disks
+    
+    def calc_connections(self, reduced=False):
+        caps = self.use_caps()
+        if reduced and caps['sources']['/proc/net/sockstat']:
+            self.connections = self.read_sockstat()
+            self.tcp_states = None
+        elif caps['paths']['calc_connections'] == 'proc':
+            self.connections = self.read_proc_connections()
+        else:
+            if caps['paths']['calc_connections'] == 'ss':
+                connections = check_output(['ss', '-tun']).split('\n')[1:]
             else:
-                self.ipv4 = ipv4.strip()
-            #print ipv4
-        except:
-            self.ipv4 = 'N/A'
-        # IPv6 address
-        try:
-            ipinfo = check_output(['ip','addr','show',self.nic]).split()
-            ipv6idx = ipinfo.index('inet6')+1
-            ipv6 = ipinfo[ipv6idx]
-            self.ipv6 = ipv6.split('/')[0]
-        except:
-            self.ipv6 = 'N/A'
+                connections = check_output(['netstat', '-tun']).split('\n')[2:]
+            connections.remove('')
+            self.connections = len(connections)
+        self.use_facts('net', self.detect_nic)
         
         # Defaults for TX and RX
         self.tx = '0'
         self.rx = '0'
-        netstatisticspath = '/sys/class/net/{0}/statistics'.format(self.nic)
-        if os.path.isdir(netstatisticspath):
+        self.nic_counters = None
+        if caps['sources']['/proc/net/dev']:
+            self.nic_counters = (time.time(), self.read_nic_counters())
+        netstatisticspath = self.path('/sys/class/net/{0}/statistics'.format(self.nic))
+        if self.nic_counters is not None and self.nic in self.nic_counters[1]:
+            self.rx = self.nic_counters[1][self.nic][0]
+            self.tx = self.nic_counters[1][self.nic][4]
+        elif caps['sources']['/sys/class/net'] and os.path.isdir(netstatisticspath):
             rx = open(os.path.join(netstatisticspath,'rx_bytes'),'r')
             rxbytes = rx.readline()
             self.rx = rxbytes.strip()
@@ -225,7 +1459,7 @@ class TTagent(object):
             txbytes = tx.readline()
             self.tx = txbytes.strip()
             tx.close()
-        else:
+        elif caps['tools']['ip']:
             try:
                 netstats = check_output(['ip','-s','link','show',self.nic])
                 netstatsplit = netstats.split('\n')
@@ -253,55 +1487,552 @@ class TTagent(object):
         self.tx = int(self.tx)
         self.rx = int(self.rx)
     
+    def detect_nic(self):
+        # The ip fallbacks only run where the manifest found ip
+        ip_available = self.use_caps()['tools']['ip'] is not None
+        try:
+            self.nic = self.read_route_nic('8.8.8.8')
+        except:
+            self.nic = 'N/A'
+            if ip_available:
+                try:
+                    irout = check_output(['ip', 'route', 'get', '8.8.8.8']).split()
+                    devidx = irout.index('dev')+1
+                    self.nic = irout[devidx]
+                except:
+                    try:
+                        irout = check_output(['ip','link','show']).split('\n')
+                        irout.remove('')
+                        iroutarr = [rout.split() for rout in irout]
+                        self.nic = [rout[1][:-1] for rout in iroutarr if 'eth' in rout[1][0:3]][0]
+                    except:
+                        self.nic = 'N/A'
+        try:
+            self.addresses = self.read_addresses()
+        except (IOError, OSError):
+            self.addresses = {}
+        # IPv4 address
+        try:
+            self.ipv4 = self.read_ipv4(self.nic)
+        except:
+            self.ipv4 = 'N/A'
+            if ip_available:
+                try:
+                    ipinfo = check_output(['ip','addr','show',self.nic]).split("inet ")[1].split("/")[0]
+                    ipv4 = ipinfo.strip()
+                    if ipv4 == '127.0.0.1':
+                        ipinfo = check_output(['ip','addr','show',self.nic]).split("inet ")[2].split("/")[0]
+                        ipv4 = ipinfo.strip()
+                        self.ipv4 = ipv4.strip()
+                    else:
+                        self.ipv4 = ipv4.strip()
+                    #print ipv4
+                except:
+                    self.ipv4 = 'N/A'
+        # IPv6 address
+        try:
+            self.ipv6 = self.read_ipv6(self.nic)
+        except:
+            self.ipv6 = 'N/A'
+            if ip_available:
+                try:
+                    ipinfo = check_output(['ip','addr','show',self.nic]).split()
+                    ipv6idx = ipinfo.index('inet6')+1
+                    ipv6 = ipinfo[ipv6idx]
+                    self.ipv6 = ipv6.split('/')[0]
+                except:
+                    self.ipv6 = 'N/A'
+    
+    def read_sockstat(self):
+        """ Sockets in use from the kernel's own totals, listening ones included, without walking the socket tables """
+        n_sockets = 0
+        for sockstat in ('sockstat', 'sockstat6'):
+            try:
+                f = open(self.path('/proc/net/' + sockstat), 'r')
+                lines = f.readlines()
+                f.close()
+            except IOError:
+                continue
+            for line in lines:
+                fields = line.split()
+                if fields and fields[0] in ('TCP:', 'UDP:', 'TCP6:', 'UDP6:'):
+                    n_sockets += int(fields[fields.index('inuse') + 1])
+        return n_sockets
+    
+    def read_proc_connections(self):
+        """ Number of non-listening tcp and udp sockets, as counted from `ss -tun`, and sockets per tcp state """
+        tcp, udp = {}, {}
+        for table, counts in (('tcp', tcp), ('tcp6', tcp), ('udp', udp), ('udp6', udp)):
+            try:
+                self.read_socket_states(table, counts)
+            except IOError:
+                # No IPv6 on this host
+                continue
+        self.tcp_states = dict((name, tcp.get(state, 0)) for state, name in TCP_STATES)
+        self.udp_sockets = sum(udp.values())
+        n_connections = sum([count for state, count in tcp.items() if state not in SS_HIDDEN_STATES])
+        # Unconnected udp sockets show up as CLOSE
+        n_connections += sum([count for state, count in udp.items() if state not in SS_HIDDEN_STATES])
+        return n_connections
+    
+    def read_socket_states(self, table, counts):
+        """ Add the number of sockets per state in /proc/net/<table> to counts, a chunk at a time """
+        # The state follows the local and remote address:port, after the 'sl:' column
+        state_offset = 78 if table.endswith('6') else 30
+        f = open(self.path('/proc/net/' + table), 'rb')
+        f.readline()
+        rest = b''
+        while True:
+            chunk = f.read(SOCKET_CHUNK)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1
+            rest = chunk[end:]
+            if self.count_fixed_width_states(chunk[:end], state_offset, counts):
+                continue
+            for line in chunk[:end].splitlines():
+                pos = line.find(b':') + state_offset
+                state = line[pos:pos+2].decode('ascii')
+                counts[state] = counts.get(state, 0) + 1
+        f.close()
+    
+    def count_fixed_width_states(self, lines, state_offset, counts):
+        """ Count states of equally padded lines (the kernel pads IPv4 tables) without splitting them
+        
+        Every line has to end at the same width and have its 'sl:' colon and the leading 0 of its
+        state in the same columns, otherwise nothing is counted and False is returned.
+        """
+        width = lines.find(b'\n') + 1
+        colon = lines.find(b':')
+        n_lines = len(lines) // width if width > 0 else 0
+        if n_lines == 0 or len(lines) != n_lines * width:
+            return False
+        if lines[width-1::width] != b'\n' * n_lines or lines[colon::width] != b':' * n_lines:
+            return False
+        if lines[colon+state_offset::width] != b'0' * n_lines:
+            return False
+        # States run from 01 to 0C, so their second digit tells them apart
+        states = lines[colon+state_offset+1::width]
+        for state, name in TCP_STATES:
+            n_state = states.count(state[1:].encode('ascii'))
+            if n_state:
+                counts[state] = counts.get(state, 0) + n_state
+        return True
+    
+    def read_route_nic(self, target):
+        """ Interface of the most specific route to target, as `ip route get` """
+        import socket
+        target_addr = struct.unpack('=I', socket.inet_aton(target))[0]
+        f = open(self.path('/proc/net/route'), 'r')
+        routes = [line.split() for line in f.readlines()[1:]]
+        f.close()
+        best = None
+        for route in routes:
+            # Iface Destination Gateway Flags RefCnt Use Metric Mask ...
+            dest, flags, metric, mask = int(route[1], 16), int(route[3], 16), int(route[6]), int(route[7], 16)
+            if not flags & 0x1 or target_addr & mask != dest:
+                continue
+            key = (bin(mask).count('1'), -metric)
+            if best is None or key > best[0]:
+                best = (key, route[0])
+        if best is not None:
+            return best[1]
+        # No route out, settle for the first ethernet interface
+        nics = list()
+        for nic in os.listdir(self.path('/sys/class/net')):
+            if nic.startswith('eth'):
+                f = open(self.path('/sys/class/net/{0}/ifindex'.format(nic)), 'r')
+                nics.append((int(f.read()), nic))
+                f.close()
+        return sorted(nics)[0][1]
+    
+    def read_nic_counters(self):
+        """ NIC_COUNTERS of every interface but loopback, all from one read of /proc/net/dev """
+        f = open(self.path('/proc/net/dev'), 'r')
+        lines = f.readlines()[2:]
+        f.close()
+        counters = {}
+        for line in lines:
+            # Old kernels leave no space between the colon and large rx_bytes
+            nic, values = line.split(':', 1)
+            nic = nic.strip()
+            if nic == 'lo':
+                continue
+            values = values.split()
+            counters[nic] = [int(values[col]) for name, col in NIC_COUNTERS]
+        return counters
+    
+    def calc_nic_rates(self):
+        """ (nic, rx B/s, tx B/s, rx packets/s, tx packets/s, errors, drops) since the previous counters """
+        self.nic_rates = None
+        if self.nic_counters is None or self.nic_prev is None:
+            return
+        now, counters = self.nic_counters
+        before, prev = self.nic_prev
+        elapsed = now - before
+        if elapsed <= 0:
+            return
+        rates = list()
+        for nic in sorted(counters):
+            if nic not in prev:
+                continue
+            gaps = [counter_gap(val, prev_val) for val, prev_val in zip(counters[nic], prev[nic])]
+            rates.append((nic, gaps[0] / elapsed, gaps[4] / elapsed, gaps[1] / elapsed, gaps[5] / elapsed,
+                          gaps[2] + gaps[6], gaps[3] + gaps[7]))
+        self.nic_rates = rates
+    
+    def calc_diskstats(self):
+        if not self.use_caps()['sources']['/proc/diskstats']:
+            self.disk_counters = None
+            return
+        self.disk_counters = (time.time(), self.read_disk_counters())
+    
+    def read_disk_counters(self):
+        """ DISK_COUNTERS of every block device from one read of /proc/diskstats
+        
+        Partitions are left out unless diskio_partitions = 1, telling them from whole disks by the
+        one listing of /sys/block, and so are devices whose name starts as a diskio_exclude entry.
+        """
+        f = open(self.path('/proc/diskstats'), 'r')
+        lines = f.readlines()
+        f.close()
+        excluded = tuple([prefix.strip() for prefix in self.config.get('diskio_exclude', DISK_EXCLUDE).split(',') if prefix.strip()])
+        disks = None
+        if self.config.get('diskio_partitions') != '1' and self.use_caps()['sources']['/sys/block']:
+            disks = set(os.listdir(self.path('/sys/block')))
+        counters = {}
+        for line in lines:
+            # major minor device, then the counters
+            values = line.split()
+            device = values[2]
+            if excluded and device.startswith(excluded):
+                continue
+            # sysfs spells a / in device names as !
+            if disks is not None and device.replace('/', '!') not in disks:
+                continue
+            counters[device] = [int(values[col + 3]) for name, col in DISK_COUNTERS]
+        return counters
+    
+    def calc_disk_rates(self):
+        """ (device, reads/s, writes/s, read B/s, written B/s, await ms, utilisation %) of devices with io since the previous counters """
+        self.disk_rates = None
+        if self.disk_counters is None or self.disk_prev is None:
+            return
+        now, counters = self.disk_counters
+        before, prev = self.disk_prev
+        elapsed = now - before
+        if elapsed <= 0:
+            return
+        rates = list()
+        for device in sorted(counters):
+            if device not in prev:
+                continue
+            gaps = [counter_gap(val, prev_val) for val, prev_val in zip(counters[device], prev[device])]
+            ios = gaps[0] + gaps[3]
+            if ios == 0 and gaps[6] == 0:
+                continue
+            # Await is the ms requests took from queueing to completion, io_ms the ms the device was busy
+            rates.append((device, gaps[0] / elapsed, gaps[3] / elapsed, gaps[1] * 512 / elapsed, gaps[4] * 512 / elapsed,
+                          float(gaps[2] + gaps[5]) / ios if ios else 0.0, min(gaps[6] / 10.0 / elapsed, 100.0)))
+        self.disk_rates = rates
+    
+    def calc_saturation(self):
+        """ Memory headroom, paging and OOM events and pressure stalls, from one read of each file
+        
+        Kept as fixed layouts, MEMINFO_FIELDS and VMSTAT_COUNTERS values and per PSI_RESOURCES and
+        PSI_KINDS the avg10, avg60, avg300 and total, the event counters then the stall totals
+        becoming the counters calc_saturation_rates takes deltas of.
+        """
+        self.meminfo = self.read_meminfo()
+        sources = self.use_caps()['sources']
+        vmstat = self.read_layout('/proc/vmstat', VMSTAT_COUNTERS) if sources['/proc/vmstat'] else array('d', [0.0]) * len(VMSTAT_COUNTERS)
+        self.pressure = self.read_psi() if sources['/proc/pressure'] else None
+        counters = array('d', vmstat)
+        counters.extend(self.pressure[3::4] if self.pressure is not None else array('d', [0.0]) * (len(PSI_RESOURCES) * len(PSI_KINDS)))
+        self.saturation_counters = (time.time(), counters)
+    
+    def read_meminfo(self):
+        """ MEMINFO_FIELDS, read once per pass over the collectors for calc_hardware and calc_saturation """
+        if self.run_meminfo is None:
+            self.run_meminfo = self.read_layout('/proc/meminfo', MEMINFO_FIELDS)
+        return self.run_meminfo
+    
+    def read_layout(self, path, names):
+        """ Values of names in a file of 'name value' lines, in the order of names, from one read
+        
+        The line each name was found on is kept per path, later reads only look at those lines and
+        search the file again when a name moved. Names the file does not have read as 0.
+        """
+        f = open(self.path(path), 'r')
+        lines = f.readlines()
+        f.close()
+        values = array('d', [0.0]) * len(names)
+        positions = self.layouts.get(path)
+        for attempt in (0, 1):
+            if positions is None:
+                found = dict((line.split(None, 1)[0], pos) for pos, line in enumerate(lines) if line.strip())
+                positions = [found.get(name, -1) for name in names]
+            try:
+                for slot, pos in enumerate(positions):
+                    if pos < 0:
+                        continue
+                    fields = lines[pos].split()
+                    if fields[0] != names[slot]:
+                        raise ValueError(fields[0])
+                    values[slot] = float(fields[1])
+                break
+            except (IndexError, ValueError):
+                positions = None
+        self.layouts[path] = positions
+        return values
+    
+    def read_psi(self):
+        """ avg10, avg60, avg300 and total of each PSI_KINDS line of each PSI_RESOURCES file, None without pressure stall information """
+        pressure = array('d', [0.0]) * (len(PSI_RESOURCES) * len(PSI_KINDS) * 4)
+        for res, resource in enumerate(PSI_RESOURCES):
+            try:
+                lines = self.read_cgroup_file(self.path('/proc/pressure/' + resource)).split('\n')
+            except OSError:
+                # psi=0 on the kernel command line leaves the files unreadable
+                return None
+            for line in lines:
+                fields = line.split()
+                # cpu has no full line before Linux 5.13
+                if not fields or fields[0] not in PSI_KINDS:
+                    continue
+                start = (res * len(PSI_KINDS) + PSI_KINDS.index(fields[0])) * 4
+                for pos, field in enumerate(fields[1:5]):
+                    pressure[start + pos] = float(field.split('=')[1])
+        return pressure
+    
+    def calc_saturation_rates(self):
+        """ VMSTAT_COUNTERS per second, oom_kill as a count, and percent of the time stalled per resource and kind since the previous counters """
+        self.vmstat_rates = self.psi_stalled = None
+        if self.saturation_counters is None or self.saturation_prev is None:
+            return
+        now, counters = self.saturation_counters
+        before, prev = self.saturation_prev
+        elapsed = now - before
+        if elapsed <= 0 or len(counters) != len(prev):
+            return
+        gaps = [counter_gap(int(val), int(prev_val)) for val, prev_val in zip(counters, prev)]
+        events = len(VMSTAT_COUNTERS)
+        self.vmstat_rates = [(name, gap if name == 'oom_kill' else gap / elapsed) for name, gap in zip(VMSTAT_COUNTERS, gaps[0:events])]
+        # Totals are in us, stalling every us of the interval is 100%
+        self.psi_stalled = [min(gap / elapsed / 10000.0, 100.0) for gap in gaps[events:]]
+    
+    def read_addresses(self):
+        """ Addresses per interface, IPv4 from one SIOCGIFCONF and IPv6 from /proc/net/if_inet6 """
+        import fcntl, ctypes, socket
+        addresses = {}
+        # struct ifreq is the 16 byte name and a union the size of struct ifmap
+        ifreq_size = 40 if struct.calcsize('P') == 8 else 32
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            slots = 64
+            while True:
+                buf = ctypes.create_string_buffer(ifreq_size * slots)
+                ifconf = fcntl.ioctl(s.fileno(), 0x8912, struct.pack('iP', len(buf), ctypes.addressof(buf)))
+                size = struct.unpack('iP', ifconf)[0]
+                # A full buffer may have cut the list short
+                if size < len(buf):
+                    break
+                slots *= 4
+        finally:
+            s.close()
+        data = buf.raw
+        for pos in range(0, size, ifreq_size):
+            nic = data[pos:pos+16].split(b'\0', 1)[0].decode('ascii')
+            # eth0:1 style labels are addresses of eth0
+            addresses.setdefault(nic.split(':')[0], []).append(socket.inet_ntoa(data[pos+20:pos+24]))
+        try:
+            f = open(self.path('/proc/net/if_inet6'), 'r')
+        except IOError:
+            # No IPv6 on this host
+            return addresses
+        addrs = [line.split() for line in f.readlines()]
+        f.close()
+        # address ifindex prefixlen scope flags name, global scope first
+        addrs.sort(key=lambda addr: addr[3] != '00')
+        for addr in addrs:
+            addresses.setdefault(addr[5], []).append(socket.inet_ntop(socket.AF_INET6, unhexlify(addr[0])))
+        return addresses
+    
+    def read_ipv4(self, nic):
+        """ Primary IPv4 address of nic from read_addresses """
+        if not self.addresses:
+            raise ValueError('no addresses read')
+        ipv4 = [addr for addr in self.addresses.get(nic, []) if ':' not in addr and addr != '127.0.0.1']
+        if len(ipv4) == 0:
+            return 'N/A'
+        return ipv4[0]
+    
+    def read_ipv6(self, nic):
+        """ IPv6 address of nic from read_addresses, global scope first """
+        if not self.addresses:
+            raise ValueError('no addresses read')
+        ipv6 = [addr for addr in self.addresses.get(nic, []) if ':' in addr]
+        if len(ipv6) == 0:
+            return 'N/A'
+        return ipv6[0]
+    
     def calc_load(self):
         # Average system load
-        ld = open('/proc/loadavg','r')
+        ld = open(self.path('/proc/loadavg'),'r')
         ldavg = ld.read()
         self.load = " ".join(ldavg.split()[0:3])
         ld.close()
         self.time = int(time.time())
-        statfile = open('/proc/stat','r')
+        statfile = open(self.path('/proc/stat'),'r')
         statf = statfile.readlines()
         statfile.close()
         stat = statf[0]
         stat = stat.split()[1:]
-        stat = map(int, stat)
+        stat = [int(val) for val in stat]
         self.cpu = sum(stat[0:4])
         self.io = stat[3]+stat[4]
         self.idle = stat[3]
+        self.read_cpu_counters(statf)
+    
+    def read_cpu_counters(self, statf):
+        """ Jiffies per CPU_CATEGORIES entry of the cpu line (row 0) and every cpuN line (row N+1) """
+        if self.cpu_counters is None:
+            rows = self.possible_cpus() + 1
+            self.cpu_counters = array('d', [0.0]) * (rows * len(CPU_CATEGORIES))
+            self.cpu_online = array('b', [0]) * rows
+        counters, online = self.cpu_counters, self.cpu_online
+        for row in range(len(online)):
+            online[row] = 0
+        width = len(CPU_CATEGORIES)
+        for line in statf:
+            if not line.startswith('cpu'):
+                break
+            fields = line.split()
+            if fields[0] == 'cpu':
+                row = 0
+            else:
+                row = int(fields[0][3:]) + 1
+            if row >= len(online):
+                # Hot-added beyond what sysfs announced as possible
+                counters.extend(array('d', [0.0]) * ((row + 1 - len(online)) * width))
+                online.extend(array('b', [0]) * (row + 1 - len(online)))
+            # Older kernels report fewer categories, guest time is already part of user and nice
+            values = [float(val) for val in fields[1:width+1]] + [0.0] * (width + 1 - len(fields))
+            counters[row*width:(row+1)*width] = array('d', values)
+            online[row] = 1
+    
+    def online_cpus(self):
+        """ Number of online cpus under root, from sysfs or the cpuN lines of /proc/stat """
+        try:
+            f = open(self.path('/sys/devices/system/cpu/online'), 'r')
+            online = f.read().strip()
+            f.close()
+            cpus = 0
+            for span in online.split(','):
+                first, last = (span.split('-') + [span])[0:2]
+                cpus += int(last) - int(first) + 1
+            return cpus
+        except (IOError, ValueError):
+            pass
+        f = open(self.path('/proc/stat'), 'r')
+        cpus = len([line for line in f if line.startswith('cpu') and not line.startswith('cpu ')])
+        f.close()
+        return max(cpus, 1)
+    
+    def possible_cpus(self):
+        """ Highest possible cpu number + 1, so hot-plugged cpus fit the counter array """
+        try:
+            f = open(self.path('/sys/devices/system/cpu/possible'),'r')
+            possible = f.read().strip()
+            f.close()
+            return int(possible.replace(',', '-').split('-')[-1]) + 1
+        except (IOError, ValueError):
+            return os.sysconf('SC_NPROCESSORS_CONF')
+    
+    def calc_cpu_breakdown(self):
+        """ Share of each CPU_CATEGORIES entry overall and busy % per online cpu since the previous snapshot """
+        self.cpu_breakdown = None
+        self.cpu_cores_busy = None
+        if self.cpu_prev is None:
+            return
+        width = len(CPU_CATEGORIES)
+        current, previous = self.cpu_counters, self.cpu_prev
+        rows = min(len(self.cpu_online), len(self.cpu_prev_online))
+        busy = list()
+        for row in range(rows):
+            if not (self.cpu_online[row] and self.cpu_prev_online[row]):
+                # Offline now or then, no delta to report
+                continue
+            gaps = [current[i] - previous[i] for i in range(row*width, (row+1)*width)]
+            total = sum(gaps)
+            if min(gaps) < 0 or total <= 0:
+                # Counters went back, the host rebooted or the cpu was replugged
+                continue
+            if row == 0:
+                self.cpu_breakdown = [100.0 * gap / total for gap in gaps]
+            else:
+                # Busy is everything but idle and iowait
+                busy.append((row - 1, 100.0 * (total - gaps[3] - gaps[4]) / total))
+        self.cpu_cores_busy = busy
+    
+    def sample_counters(self):
+        """ Add the cpu, iowait and nic rates since the previous call to the sample window """
+        statfile = open(self.path('/proc/stat'),'r')
+        stat = [int(val) for val in statfile.readline().split()[1:]]
+        statfile.close()
+        rx, tx = 0, 0
+        netstatisticspath = self.path('/sys/class/net/{0}/statistics'.format(getattr(self, 'nic', 'N/A')))
+        if os.path.isdir(netstatisticspath):
+            f = open(os.path.join(netstatisticspath,'rx_bytes'),'r')
+            rx = int(f.read())
+            f.close()
+            f = open(os.path.join(netstatisticspath,'tx_bytes'),'r')
+            tx = int(f.read())
+            f.close()
+        # Same split as calc_load: cpu is user+nice+system+idle, io is idle+iowait
+        current = (time.time(), sum(stat[0:4]), stat[3]+stat[4], stat[3], rx, tx)
+        previous, self.sample_prev = self.sample_prev, current
+        if previous is None:
+            return
+        gaps = [now - before for now, before in zip(current, previous)]
+        if min(gaps) < 0 or gaps[0] <= 0:
+            # Counter reset, start over from this sample
+            return
+        elapsed, cpu_gap, io_gap, idle_gap, rx_gap, tx_gap = gaps
+        load_cpu = 100.0 * (cpu_gap - idle_gap) / cpu_gap if cpu_gap > 0 else 0.0
+        load_io = 100.0 * (io_gap - idle_gap) / io_gap if io_gap > 0 else 0.0
+        self.samples.add((load_cpu, load_io, rx_gap / elapsed, tx_gap / elapsed))
+    
+    def window_field(self):
+        """ 'metric:min/avg/max/p95;...' over the samples since the last post """
+        return ';'.join(['{0}:{1:.1f}/{2:.1f}/{3:.1f}/{4:.1f}'.format(metric, *aggregate)
+                         for metric, aggregate in zip(self.samples.metrics, self.samples.aggregate())])
     
     def read_msdata(self):
-        if os.path.isfile(self.msdatalog):
-            ms = open(self.msdatalog,'r')
-            msdata = ms.read()
-            ms.close()
-            msdata = msdata.split()
-            msdata = map(int,msdata)
-            self.data = msdata
+        self.read_state()
+        self.calc_cpu_breakdown()
+        self.calc_nic_rates()
+        self.calc_disk_rates()
+        self.calc_saturation_rates()
+        if self.data is not None:
             self.interval = self.time - self.data[0]
             self.cpu_gap = self.cpu - self.data[1]
             self.io_gap = self.io - self.data[2]
             self.idle_gap = self.idle - self.data[3]
             
             if self.cpu_gap > 0:
-                self.load_cpu = (1000*(self.cpu_gap-self.idle_gap)/self.cpu_gap+5)/10
+                self.load_cpu = (1000*(self.cpu_gap-self.idle_gap)//self.cpu_gap+5)//10
             else:
                 self.load_cpu = 0
             
             if self.io_gap > 0:
-                self.load_io = (1000*(self.io_gap-self.idle_gap)/self.io_gap+5)/10
+                self.load_io = (1000*(self.io_gap-self.idle_gap)//self.io_gap+5)//10
             else:
                 self.load_io = 0
             
-            if self.rx > self.data[4]:
-                self.rx_gap = self.rx - self.data[4]
-            else:
-                self.rx_gap = 0
-            
-            if self.tx > self.data[5]:
-                self.tx_gap = self.tx - self.data[5]
-            else:
-                self.tx_gap = 0
+            self.rx_gap = counter_gap(self.rx, self.data[4])
+            self.tx_gap = counter_gap(self.tx, self.data[5])
         else:
             self.interval = 0
             self.cpu_gap  = 0
@@ -313,86 +2044,781 @@ class TTagent(object):
             self.tx_gap   = 0
             
     def write_msdata(self):
-        msdatalog = open(self.msdatalog, 'w')
-        msdatalog.write("{0} {1} {2} {3} {4} {5}\n".format(self.time, self.cpu, self.io, self.idle, self.rx, self.tx))
-        msdatalog.close()
+        # The daemon keeps the previous sample in memory
+        self.data = [self.time, self.cpu, self.io, self.idle, self.rx, self.tx]
+        self.cpu_prev = array('d', self.cpu_counters)
+        self.cpu_prev_online = array('b', self.cpu_online)
+        self.nic_prev = self.nic_counters
+        self.disk_prev = self.disk_counters
+        self.saturation_prev = self.saturation_counters
+        self.write_state()
+    
+    def find_cgroup_root(self):
+        """ Mount point of the cgroup v2 hierarchy, unified or below /sys/fs/cgroup on hybrid hosts, or None """
+        if self.cgroup_root is None:
+            root = self.use_caps()['paths']['calc_cgroups']
+            self.cgroup_root = self.path(root) if root else ''
+        return self.cgroup_root or None
     
-    def get_network_latency(self):
-        def get_latency(server):
-            pingcmd = ['ping', '-c', '2', '-w', '2', server]
+    def read_cgroup_limits(self):
+        """ Limits of the cgroup we see as the root, set inside a container with its own cgroup namespace
+        
+        A memory.max below MemTotal replaces ram_total, and ram_usage becomes what the container
+        uses, page cache it could drop left out, as `docker stats` shows. A cpu.max quota is
+        reported in cores. The host's root cgroup has neither file.
+        """
+        self.cgroup_limits = None
+        root = self.find_cgroup_root()
+        if root is None:
+            return
+        limits = list()
+        try:
+            quota, period = self.read_cgroup_file(root + '/cpu.max').split()
+            if quota != 'max':
+                limits.append(('cpu', '{0:.2f}'.format(float(quota) / float(period))))
+        except (OSError, ValueError):
+            pass
+        try:
+            memory_max = self.read_cgroup_file(root + '/memory.max').strip()
+            if memory_max != 'max' and int(memory_max) < self.ram_total:
+                stat = dict([line.split() for line in self.read_cgroup_file(root + '/memory.stat').splitlines()])
+                self.ram_total = int(memory_max)
+                self.ram_usage = int(self.read_cgroup_file(root + '/memory.current')) - int(stat.get('inactive_file', 0))
+                limits.append(('mem', self.ram_total))
+        except (OSError, ValueError):
+            pass
+        self.cgroup_limits = limits
+    
+    def calc_cgroups(self):
+        """ Rates per cgroup v2 group and the cgroup_top busiest in self.cgroups, rereading only what changed
+        
+        cpu.stat and io.stat count a group together with everything below it, so a group whose cpu
+        and io counters have not moved since they were last read is skipped with its whole subtree,
+        keeping its counters and memory. The directory tree is cached too, and walked again every
+        cgroup_rescan seconds or once the root's count of descendants changes; every counter is
+        read again then, which also refreshes the memory of idle groups.
+        """
+        import heapq
+        root = self.find_cgroup_root()
+        if root is None:
+            self.cgroups = None
+            return
+        self.read_state()
+        now = time.time()
+        stat = dict([line.split() for line in self.read_cgroup_file(root + '/cgroup.stat').splitlines()])
+        full = (self.cgroup_tree is None or now - self.cgroup_scanned >= float(self.config.get('cgroup_rescan', CGROUP_RESCAN))
+                or int(stat['nr_descendants']) != len(self.cgroup_tree) - 1)
+        if full:
+            self.cgroup_tree = self.scan_cgroups(root)
+            self.cgroup_scanned = now
+        tree, prev = self.cgroup_tree, self.cgroup_prev
+        counters, usage = {}, {}
+        stack = ['']
+        while stack:
+            path = stack.pop()
             try:
-                pingout = check_output(pingcmd)
-            except:
-                return '0'
-            pingout = pingout.split('\n')
-            # Remove blank lines
+                values = self.read_cgroup_counters(root + '/' + path)
+            except OSError:
+                # Removed since the tree was walked, walk it again next time
+                self.cgroup_scanned = 0
+                continue
+            before = prev.get(path)
+            if not full and path and before is not None and values == before[1:4]:
+                # Nothing ran or did io below here since before
+                idle = [path]
+                while idle:
+                    path = idle.pop()
+                    if path in prev:
+                        counters[path] = prev[path]
+                        usage[path] = (0.0, int(prev[path][4]), 0.0, 0.0, 0.0, 0.0, 0.0)
+                        idle.extend([path + '/' + child for child in tree.get(path, ())])
+                continue
+            try:
+                memory = int(self.read_cgroup_file(root + '/' + path + '/memory.current'))
+            except OSError:
+                # Without the memory controller enabled for the group
+                memory = 0
+            counters[path] = (now,) + values + (memory,)
+            cpu = read = write = 0.0
+            if before is not None and now > before[0]:
+                elapsed = now - before[0]
+                # usec of cpu as percent of one cpu
+                cpu = counter_gap(values[0], int(before[1])) / 10000.0 / elapsed
+                read = counter_gap(values[1], int(before[2])) / elapsed
+                write = counter_gap(values[2], int(before[3])) / elapsed
+            pressure = [self.read_pressure(root + '/' + path + '/' + resource + '.pressure') or 0.0 for resource in ('cpu', 'memory', 'io')]
+            usage[path] = tuple([cpu, memory, read, write] + pressure)
+            stack.extend([(path + '/' + child).lstrip('/') for child in tree.get(path, ())])
+        self.cgroup_prev = counters
+        usage.pop('', None)
+        self.cgroups = heapq.nlargest(int(self.config.get('cgroup_top', CGROUP_TOP)), usage.items(), key=lambda item: (item[1][0], item[1][1]))
+    
+    def scan_cgroups(self, root):
+        """ {path: [child names]} of every group below root, '' being root itself """
+        tree = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            tree[dirpath[len(root):].lstrip('/')] = dirnames
+        return tree
+    
+    def read_cgroup_counters(self, group):
+        """ cpu usec, and io read and written bytes over every device, of a group """
+        usage_usec = int(self.read_cgroup_file(group + '/cpu.stat').split(None, 2)[1])
+        rbytes = wbytes = 0
+        try:
+            for line in self.read_cgroup_file(group + '/io.stat').splitlines():
+                for field in line.split()[1:]:
+                    if field.startswith('rbytes='):
+                        rbytes += int(field[7:])
+                    elif field.startswith('wbytes='):
+                        wbytes += int(field[7:])
+        except OSError:
+            # Without the io controller enabled for the group
+            pass
+        return (usage_usec, rbytes, wbytes)
+    
+    def read_cgroup_file(self, path):
+        """ Whole of a small kernel file, through os.open to stay clear of file object overhead """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            data = os.read(fd, 65536)
+        finally:
+            os.close(fd)
+        if not isinstance(data, str):
+            data = data.decode('utf8', 'replace')
+        return data
+    
+    def read_pressure(self, path):
+        """ 'some avg10' percent of a pressure stall file, None when there is none """
+        try:
+            some = self.read_cgroup_file(path).split(None, 2)
+        except OSError:
+            return None
+        return float(some[1].split('=')[1])
+    
+    def escape_cgroup(self, path):
+        return path.replace('%', '%25').replace(';', '%3B').replace(':', '%3A')
+    
+    def read_boot_id(self):
+        try:
+            f = open(self.path('/proc/sys/kernel/random/boot_id'), 'r')
+            boot_id = f.read().strip()
+            f.close()
+            return boot_id
+        except IOError:
+            return ''
+    
+    def read_state(self):
+        """ Previous counters from tt-state.dat, once, unless they are from another boot or a cut short file
+        
+        A 'TTst' magic, STATE_VERSION and the boot id, then per section its name, its length
+        and what write_<name>_state wrote. Sections this version does not know are skipped.
+        """
+        if self.state_read:
+            return
+        self.state_read = True
+        if not os.path.isfile(self.statelog):
+            return
+        f = open(self.statelog, 'rb')
+        try:
+            magic, version, boot_id = struct.unpack('=4sH36s', f.read(42))
+            if magic != b'TTst' or version != STATE_VERSION or boot_id.rstrip(b'\0').decode('ascii') != self.read_boot_id():
+                return
             while True:
-                try:
-                    pingout.remove('')
-                except:
+                header = f.read(12)
+                if not header:
                     break
-            for line in pingout:
-                if 'rtt min/avg/max/mdev' in line:
-                    pingres = line
-            pingres = pingres.split()
-            # Compare to pattern: ['rtt', 'min/avg/max/mdev', '=', '245.174/246.370/247.567/1.295', 'ms']
-            validx = pingres.index('=') + 1
-            vals = pingres[validx]
-            mdev = vals.split('/')[-1]
-            return mdev
-        
-        self.ping_eu = get_latency('146.66.158.1')
-        self.ping_us = get_latency('8.8.8.8')
-        self.ping_as = get_latency('116.202.224.146')
+                name, length = struct.unpack('=8sI', header)
+                name = name.rstrip(b'\0').decode('ascii')
+                end = f.tell() + length
+                if name in STATE_SECTIONS:
+                    getattr(self, 'read_{0}_state'.format(name))(f)
+                if f.tell() != end:
+                    f.seek(end)
+        except (struct.error, EOFError, ValueError):
+            # Cut short by a crash, start over
+            self.data = self.cpu_prev = self.nic_prev = self.disk_prev = self.saturation_prev = None
+            self.proc_prev = (0, array('l'), array('d'), array('d'))
+            self.proc_io_prev = {}
+            self.cgroup_prev, self.cgroup_tree = {}, None
+        finally:
+            f.close()
     
-    def post_msdata(self):
-        datapost = [self.version,
-                    self.uptime,
-                    self.sessions,
-                    self.processes,
-                    self.processes_array,
-                    self.filehandles,
-                    self.filehandles_limit,
-                    self.os_kernel,
-                    self.os_name,
-                    self.os_arch,
-                    self.cpu_name,
-                    self.cpu_cores,
-                    self.cpu_freq,
-                    self.ram_total,
-                    self.ram_usage,
-                    self.swap_total,
-                    self.swap_usage,
-                    self.disk_array,
-                    self.disk_total,
-                    self.disk_usage,
-                    self.connections,
-                    self.nic,
-                    self.ipv4,
-                    self.ipv6,
-                    self.rx,
-                    self.tx,
-                    self.rx_gap,
-                    self.tx_gap,
-                    self.load,
-                    self.load_cpu,
-                    self.load_io,
-                    self.ping_eu,
-                    self.ping_us,
-                    self.ping_as
-                    ]
+    def write_state(self):
+        """ Replace tt-state.dat atomically, so a crash leaves the old or the new file """
+        f = open(self.statelog + '.tmp', 'wb')
+        f.write(struct.pack('=4sH36s', b'TTst', STATE_VERSION, self.read_boot_id().encode('ascii')))
+        for name in STATE_SECTIONS:
+            start = f.tell()
+            f.write(struct.pack('=8sI', name.encode('ascii'), 0))
+            if getattr(self, 'write_{0}_state'.format(name))(f) is False:
+                f.seek(start)
+                f.truncate()
+                continue
+            end = f.tell()
+            f.seek(start + 8)
+            f.write(struct.pack('=I', end - start - 12))
+            f.seek(end)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(self.statelog + '.tmp', self.statelog)
+        # State files of earlier versions
+        for legacy in ('tt-data.log', 'tt-procs.dat'):
+            if os.path.isfile(os.path.join(self.ttagent_dir, legacy)):
+                os.remove(os.path.join(self.ttagent_dir, legacy))
+    
+    def read_counters_state(self, f):
+        self.data = list(struct.unpack('=qQQQQQ', f.read(48)))
+    
+    def write_counters_state(self, f):
+        """ time, cpu, io and idle jiffies, rx and tx bytes of nic """
+        if self.data is None:
+            return False
+        f.write(struct.pack('=qQQQQQ', *self.data))
+    
+    def read_cpus_state(self, f):
+        rows = struct.unpack('=I', f.read(4))[0]
+        self.cpu_prev_online, self.cpu_prev = array('b'), array('d')
+        self.cpu_prev_online.fromfile(f, rows)
+        self.cpu_prev.fromfile(f, rows * len(CPU_CATEGORIES))
+    
+    def write_cpus_state(self, f):
+        """ Rows, then the online flag and the CPU_CATEGORIES jiffies of each row """
+        if self.cpu_prev is None:
+            return False
+        f.write(struct.pack('=I', len(self.cpu_prev_online)))
+        self.cpu_prev_online.tofile(f)
+        self.cpu_prev.tofile(f)
+    
+    def read_nics_state(self, f):
+        self.nic_prev = self.read_counters_table(f, len(NIC_COUNTERS))
+    
+    def write_nics_state(self, f):
+        """ NIC_COUNTERS of every interface, as write_counters_table lays them out """
+        return self.write_counters_table(f, self.nic_prev)
+    
+    def read_disks_state(self, f):
+        self.disk_prev = self.read_counters_table(f, len(DISK_COUNTERS))
+    
+    def write_disks_state(self, f):
+        """ DISK_COUNTERS of every device, as write_counters_table lays them out """
+        return self.write_counters_table(f, self.disk_prev)
+    
+    def read_pressure_state(self, f):
+        when, count = struct.unpack('=dI', f.read(12))
+        counters = array('d')
+        counters.fromfile(f, count)
+        self.saturation_prev = (when, counters)
+    
+    def write_pressure_state(self, f):
+        """ Time read, the number of counters, then the VMSTAT_COUNTERS and the pressure stall totals """
+        if self.saturation_prev is None:
+            return False
+        when, counters = self.saturation_prev
+        f.write(struct.pack('=dI', when, len(counters)))
+        counters.tofile(f)
+    
+    def read_counters_table(self, f, width):
+        when, count, size = struct.unpack('=dII', f.read(16))
+        names = f.read(size).decode('utf8').split('\0')
+        counters = array('d')
+        counters.fromfile(f, count * width)
+        return (when, dict((name, [int(val) for val in counters[pos*width:(pos+1)*width]]) for pos, name in enumerate(names)))
+    
+    def write_counters_table(self, f, table):
+        """ Time read, the names nul separated, then the counters of each name, from a (time, {name: counters}) table """
+        if table is None or len(table[1]) == 0:
+            return False
+        when, counters = table
+        names = sorted(counters)
+        packed = '\0'.join(names).encode('utf8')
+        f.write(struct.pack('=dII', when, len(names), len(packed)))
+        f.write(packed)
+        values = array('d')
+        for name in names:
+            values.extend(array('d', [float(val) for val in counters[name]]))
+        values.tofile(f)
+    
+    def read_procs_state(self, f):
+        uptime, count = struct.unpack('=dI', f.read(12))
+        pids, starts, cputimes = array('l'), array('d'), array('d')
+        pids.fromfile(f, count)
+        starts.fromfile(f, count)
+        cputimes.fromfile(f, count)
+        self.proc_prev = (uptime, pids, starts, cputimes)
+    
+    def write_procs_state(self, f):
+        """ Uptime of the scan, then the sorted pids, their start times and cpu jiffies """
+        uptime, pids, starts, cputimes = self.proc_prev
+        if len(pids) == 0:
+            return False
+        f.write(struct.pack('=dI', uptime, len(pids)))
+        pids.tofile(f)
+        starts.tofile(f)
+        cputimes.tofile(f)
+    
+    def read_procio_state(self, f):
+        count = struct.unpack('=I', f.read(4))[0]
+        values = array('d')
+        values.fromfile(f, count * 5)
+        self.proc_io_prev = dict((int(values[pos]), tuple(values[pos+1:pos+5])) for pos in range(0, len(values), 5))
+    
+    def write_procio_state(self, f):
+        """ pid, start time, uptime, read and write bytes of each top process """
+        if not self.proc_io_prev:
+            return False
+        values = array('d')
+        for pid, io in sorted(self.proc_io_prev.items()):
+            values.append(pid)
+            values.extend(array('d', io))
+        f.write(struct.pack('=I', len(self.proc_io_prev)))
+        values.tofile(f)
+    
+    def read_cgroups_state(self, f):
+        scanned, count, size = struct.unpack('=dII', f.read(16))
+        paths = f.read(size).decode('utf8').split('\0')
+        values = array('d')
+        values.fromfile(f, count * 5)
+        self.cgroup_prev = dict((path, tuple(values[pos*5:(pos+1)*5])) for pos, path in enumerate(paths))
+        # The groups read last time make the cached tree
+        tree = dict((path, list()) for path in paths)
+        for path in paths:
+            if path:
+                parent, sep, name = path.rpartition('/')
+                tree.setdefault(parent, list()).append(name)
+        self.cgroup_tree, self.cgroup_scanned = tree, scanned
+    
+    def write_cgroups_state(self, f):
+        """ When the tree was walked, the groups as nul separated paths, then time read, cpu, io and memory of each """
+        if not self.cgroup_prev:
+            return False
+        paths = sorted(self.cgroup_prev)
+        names = '\0'.join(paths).encode('utf8')
+        f.write(struct.pack('=dII', self.cgroup_scanned, len(paths), len(names)))
+        f.write(names)
+        values = array('d')
+        for path in paths:
+            values.extend(array('d', [float(val) for val in self.cgroup_prev[path]]))
+        values.tofile(f)
+    
+    def get_network_latency(self, reduced=False):
+        """ Probe every latency target concurrently, all within one deadline """
+        import threading
+        targets = list()
+        for target in self.config.get('latency_targets', LATENCY_TARGETS).split(','):
+            if '=' not in target:
+                if target.strip():
+                    print("Warning: latency_targets entry '{0}' is not name=host, skipped".format(target.strip()))
+                continue
+            name, server = target.split('=', 1)
+            targets.append((name.strip(), server.strip()))
+        self.latency_targets = [name for name, server in targets]
+        if reduced:
+            # No probes, reported as failed ones
+            self.latency = {}
+            self.ping_eu = self.ping_us = self.ping_as = '0'
+            return
+        probe = self.config.get('latency_probe', 'auto')
+        deadline = time.time() + float(self.config.get('latency_deadline', 3))
+        latency = {}
+        
+        def get_latency(name, server):
+            try:
+                latency[name] = self.probe_latency(probe, server, deadline)
+            except:
+                pass
+        
+        threads = list()
+        for name, server in targets:
+            thread = threading.Thread(target=get_latency, args=(name, server))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        
+        # Probes that failed or missed the deadline report 0, as a failed ping did, ping_* being the mdev
+        self.latency = dict(latency)
+        self.ping_eu = self.latency.get('eu', ('0',) * 4)[3]
+        self.ping_us = self.latency.get('us', ('0',) * 4)[3]
+        self.ping_as = self.latency.get('as', ('0',) * 4)[3]
+    
+    def probe_latency(self, probe, server, deadline):
+        """ (min, avg, max, mdev) round trip times in ms for server, and the percent of probes lost """
+        import socket
+        if probe == 'ping':
+            return self.ping_latency(server, deadline)
+        if probe == 'tcp':
+            return self.tcp_latency(server, deadline)
+        if probe == 'auto' and self.use_caps()['paths']['get_network_latency'] == 'ping':
+            return self.ping_latency(server, deadline)
+        try:
+            return self.icmp_latency(server, deadline)
+        except socket.error:
+            # ICMP datagram sockets need net.ipv4.ping_group_range to include our group
+            if probe == 'icmp':
+                raise
+            return self.ping_latency(server, deadline)
+    
+    def ping_latency(self, server, deadline):
+        pingcmd = ['ping', '-c', str(LATENCY_PROBES), '-w', str(max(int(deadline - time.time()), 1)), server]
+        pingout = check_output(pingcmd)
+        pingout = pingout.split('\n')
+        loss = '0'
+        for line in pingout:
+            if 'rtt min/avg/max/mdev' in line:
+                pingres = line
+            if 'packet loss' in line:
+                # '2 packets transmitted, 1 received, 50% packet loss, time 1001ms'
+                loss = [field for field in line.split() if field.endswith('%')][0][:-1]
+        pingres = pingres.split()
+        # Compare to pattern: ['rtt', 'min/avg/max/mdev', '=', '245.174/246.370/247.567/1.295', 'ms']
+        validx = pingres.index('=') + 1
+        vals = pingres[validx]
+        return tuple(vals.split('/')) + (loss,)
+    
+    def icmp_latency(self, server, deadline):
+        """ Echo requests over an unprivileged ICMP datagram socket, no setuid ping required """
+        import socket
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        rtts = list()
+        try:
+            address = socket.gethostbyname(server)
+            for seq in range(LATENCY_PROBES):
+                # The kernel fills in the identifier and the checksum
+                s.sendto(struct.pack('!BBHHH', 8, 0, 0, 0, seq) + b'tecqto', (address, 0))
+                sent = time.time()
+                while True:
+                    s.settimeout(max(deadline - time.time(), 0.001))
+                    try:
+                        reply = s.recv(1024)
+                    except socket.timeout:
+                        return self.latency_stats(rtts)
+                    if reply[0:1] == b'\0' and struct.unpack('!H', reply[6:8])[0] == seq:
+                        rtts.append((time.time() - sent) * 1000)
+                        break
+        finally:
+            s.close()
+        return self.latency_stats(rtts)
+    
+    def tcp_latency(self, server, deadline):
+        """ Time to complete (or be refused) a TCP handshake with 'host[:port]' """
+        import socket
+        import errno
+        if server.count(':') == 1:
+            host, port = server.split(':')
+        else:
+            host, port = server, 443
+        address = (socket.gethostbyname(host), int(port))
+        rtts = list()
+        for seq in range(LATENCY_PROBES):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.settimeout(max(deadline - time.time(), 0.001))
+            sent = time.time()
+            try:
+                s.connect(address)
+            except socket.timeout:
+                break
+            except socket.error as e:
+                # A reset still took one round trip
+                if e.errno != errno.ECONNREFUSED:
+                    raise
+            finally:
+                s.close()
+            rtts.append((time.time() - sent) * 1000)
+        return self.latency_stats(rtts)
+    
+    def latency_stats(self, rtts):
+        if len(rtts) == 0:
+            raise ValueError('no replies')
+        avg = sum(rtts) / len(rtts)
+        mdev = max(sum([rtt * rtt for rtt in rtts]) / len(rtts) - avg * avg, 0) ** 0.5
+        loss = 100.0 * (LATENCY_PROBES - len(rtts)) / LATENCY_PROBES
+        return tuple(['{0:.3f}'.format(val) for val in (min(rtts), avg, max(rtts), mdev)] + ['{0:.0f}'.format(loss)])
+    
+    def encode_msdata(self):
+        datapost = [getattr(self, name) for name in POST_ATTRIBUTES]
+        datapost.extend(self.extra_fields())
         # Required form is strings
-        datapost = map(str,datapost)
+        datapost = [str(field) for field in datapost]
         self.data_post_plain = datapost
-        data_post_64 = map(self.base64enc, datapost)
+        getattr(self, self.encoders[self.config.get('post_format', 'b64')])(datapost)
+    
+    def encode_b64(self, datapost):
+        """ Every field base64 encoded, space separated """
+        data_post_64 = [self.base64enc(field) for field in datapost]
         self.data_post = "token={auth}&data={dt}".format(auth=self.auth, dt=" ".join(data_post_64))
-        post_cmd = ['wget', '-q', '-o', '/dev/null', '-O', self.ttagentlog, '-T', '25', '--post-data', self.data_post, '--no-check-certificate', 'http://tecqto.com/fetch-server-data']
+    
+    def encode_delta(self, datapost):
+        """ Format d1: the fields that changed since the last acknowledged post, deflated
+        
+        The text is a 'd1 <seq> <base seq>' line, then a '<key><tab><value>' line per new or changed
+        field and a '-<key>' line per tagged field gone since the base. Base 0 means no base,
+        every field is sent. Backslashes, tabs and newlines in values are backslash escaped.
+        """
+        import zlib
+        if self.post_state is None:
+            self.read_post_state()
+        fields = self.post_fields(datapost)
+        base = self.post_state['fields']
+        lines = ['d1 {0} {1}'.format(self.post_state['seq'] + 1, self.post_state['base'])]
+        for key, value in fields:
+            if base.get(key) != value:
+                value = value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+                lines.append(key + '\t' + value)
+        keys = set([key for key, value in fields])
+        lines.extend(['-' + str(key) for key in sorted(base) if key not in keys])
+        # Sequence numbers are never reused, spooled posts keep theirs
+        self.post_state['seq'] += 1
+        self.post_pending = (self.post_state['seq'], dict(fields))
+        self.write_post_state()
+        data = '\n'.join(lines)
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+        data = zlib.compress(data, 9)
+        self.data_post = "token={auth}&format=d1&data={dt}".format(auth=self.auth, dt=self.base64enc(data))
+    
+    def post_fields(self, datapost):
+        """ (key, value) per field, fixed fields keyed by position and tagged ones by tag """
+        fields = list()
+        for pos, value in enumerate(datapost):
+            if pos < POST_FIELDS:
+                fields.append((str(pos), value))
+            else:
+                fields.append(tuple(value.split('=', 1)))
+        return fields
+    
+    def ack_post(self, retcode):
+        """ Make the post just sent the delta base once the backend accepted it
+        
+        The sample window and the governor's reasons it carried start over only then, or once
+        post_msdata spooled the post, a post that failed otherwise leaves them to the next one.
+        """
+        if retcode == 0:
+            self.samples.clear()
+            self.degraded = {}
+            self.reduced = list()
+        if self.post_pending is None:
+            return
+        if retcode == 0 and self.post_status == 202:
+            # A relay queued it without forwarding it yet, the backend may never get this base
+            return
+        if retcode == 0:
+            self.post_state['base'], self.post_state['fields'] = self.post_pending
+        elif self.post_status is not None and 400 <= self.post_status < 500:
+            # Most likely the backend lost our base, send every field next time
+            self.post_state['base'], self.post_state['fields'] = 0, {}
+        else:
+            return
+        self.post_pending = None
+        self.write_post_state()
+    
+    def read_post_state(self):
+        import json
+        self.post_state = {'seq': 0, 'base': 0, 'fields': {}}
+        if os.path.isfile(self.postlog):
+            try:
+                postlog = open(self.postlog, 'r')
+                self.post_state = json.load(postlog)
+                postlog.close()
+            except ValueError:
+                pass
+    
+    def write_post_state(self):
+        import json
+        postlog = open(self.postlog + '.tmp', 'w')
+        json.dump(self.post_state, postlog)
+        postlog.close()
+        os.rename(self.postlog + '.tmp', self.postlog)
+    
+    def post_msdata(self):
+        self.encode_msdata()
+        if self.query_buffers is not None:
+            self.update_query()
+        retcode = self.send_msdata(self.data_post)
+        self.ack_post(retcode)
+        if retcode == 0:
+            self.drain_spool()
+        elif self.post_status is None or self.post_status == 0 or self.post_status >= 500:
+            # Keep the sample for later unless the backend refused it outright
+            self.spool_msdata("{0}&time={1}".format(self.data_post, self.time))
+            # The spooled post delivers its window and the governor's reasons, the next one must not repeat them
+            self.samples.clear()
+            self.degraded = {}
+            self.reduced = list()
+        return retcode
+    
+    def send_msdata(self, data):
+        if self.config.get('post_transport', 'http') == 'wget':
+            return self.post_wget(data)
+        return self.post_http(data)
+    
+    def post_http(self, data):
+        """ POST data in-process, reusing the connection between daemon posts, within post_timeout seconds """
+        url = self.config.get('post_url', POST_URL)
+        body = data
+        if not isinstance(body, bytes):
+            body = body.encode('ascii')
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if self.config.get('post_gzip') == '1':
+            body = self.gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+        
+        started = time.time()
+        self.post_status = 0
+        try:
+            self.http_conn, status, reply = self.http_post(self.http_conn, url, body, headers, started + float(self.config.get('post_timeout', 30)))
+        except IOError as e:
+            self.http_conn = None
+            self.post_latency = (time.time() - started) * 1000
+            print("Error: Posting to {0} failed: {1}".format(url, e))
+            return 1
+        
+        self.post_status = status
+        self.post_latency = (time.time() - started) * 1000
+        agentlog = open(self.ttagentlog, 'wb')
+        agentlog.write(reply)
+        agentlog.close()
+        if 200 <= status < 300:
+            return 0
+        return 1
+    
+    def http_post(self, conn, url, body, headers, deadline):
+        """ POST body to url on conn, a kept-alive connection to reuse or None, all before deadline
+        
+        Returns (conn, status, reply) with the connection to reuse next time, or raises IOError.
+        A timer shuts the socket down at the deadline, socket timeouts alone apply per read and a
+        server trickling its reply a byte at a time would never hit them.
+        """
+        import socket, threading
+        try:
+            import httplib
+            from urlparse import urlsplit
+        except ImportError:
+            import http.client as httplib
+            from urllib.parse import urlsplit
+        url = urlsplit(url)
+        host, target = url.netloc, url.path or '/'
+        if url.query:
+            target += '?' + url.query
+        proxy = os.environ.get('http_proxy')
+        if proxy and url.scheme == 'http':
+            # Plain http through a proxy sends the absolute url to the proxy
+            host, target = urlsplit(proxy).netloc, url.geturl()
+        while True:
+            reused = conn is not None
+            if not reused:
+                if url.scheme == 'https':
+                    conn = httplib.HTTPSConnection(host)
+                else:
+                    conn = httplib.HTTPConnection(host)
+            # Resolving and connecting, also when a kept-alive connection reconnects, within the deadline
+            conn._create_connection = lambda address, timeout=None, source_address=None: self.connect_before(address, deadline, source_address)
+            watchdog = threading.Timer(max(deadline - time.time(), 0), self.abort_connection, (conn,))
+            watchdog.daemon = True
+            watchdog.start()
+            try:
+                # The timeout covers connecting, every later socket operation gets what is left
+                conn.timeout = max(deadline - time.time(), 0.001)
+                conn.request('POST', target, body, headers)
+                sock = conn.sock
+                sock.settimeout(max(deadline - time.time(), 0.001))
+                response = conn.getresponse()
+                reply = list()
+                while True:
+                    if time.time() >= deadline:
+                        raise socket.timeout('post_timeout exceeded')
+                    sock.settimeout(deadline - time.time())
+                    chunk = response.read(4096)
+                    if not chunk:
+                        break
+                    reply.append(chunk)
+                return conn, response.status, b''.join(reply)
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                conn = None
+                if time.time() >= deadline:
+                    raise IOError('post_timeout exceeded')
+                # A kept-alive connection the server has closed since, try once more on a new one
+                if not reused:
+                    raise IOError(e)
+            finally:
+                watchdog.cancel()
+    
+    def abort_connection(self, conn):
+        """ Deadline timer of http_post: shut the socket down, which ends a read or write blocked on it """
+        import socket
+        sock = conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+    
+    def connect_before(self, address, deadline, source_address=None):
+        """ Connected socket to (host, port), resolving and connecting within deadline, for http_post """
+        import socket
+        host, port = address
+        error = socket.error('no address for {0}'.format(host))
+        for family, socktype, proto, name, sockaddr in self.resolve(host, port, deadline):
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(max(deadline - time.time(), 0.001))
+            try:
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except socket.error as e:
+                error = e
+                sock.close()
+        raise error
+    
+    def resolve(self, host, port, deadline):
+        """ getaddrinfo of host, reused for RESOLVE_TTL seconds, looked up in a thread so it can not outlast deadline
+        
+        A lookup that misses the deadline falls back to the previous answer when there is one.
+        """
+        import socket, threading
+        cached = self.resolved.get((host, port))
+        if cached is not None and time.time() - cached[0] < RESOLVE_TTL:
+            return cached[1]
+        result = list()
+        
+        def lookup():
+            try:
+                result.append(socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM))
+            except socket.error as e:
+                result.append(e)
+        
+        thread = threading.Thread(target=lookup)
+        thread.daemon = True
+        thread.start()
+        thread.join(max(deadline - time.time(), 0))
+        if not result:
+            if cached is not None:
+                return cached[1]
+            raise socket.timeout('resolving {0} timed out'.format(host))
+        if isinstance(result[0], Exception):
+            raise result[0]
+        self.resolved[(host, port)] = (time.time(), result[0])
+        return result[0]
+    
+    def gzip(self, data):
+        import zlib
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    
+    def post_wget(self, data):
+        import subprocess
+        # wget exits 8 on any error response, it does not tell which
+        self.post_status = None
+        post_cmd = ['wget', '-q', '-o', '/dev/null', '-O', self.ttagentlog, '-T', '25', '--post-data', data, '--no-check-certificate', self.config.get('post_url', POST_URL)]
         timeout_cmd = ['timeout', '-s', 'SIGKILL', '30']
-        timeout_cmd_available = (subprocess.call(['command','-v','timeout'],shell=True)==0)
+        timeout_cmd_available = self.use_caps()['tools']['timeout'] is not None
         
         if timeout_cmd_available:
             self.post_command = timeout_cmd + post_cmd
-            retcode = subprocess.call(post_cmd)
+            retcode = subprocess.call(self.post_command)
             return retcode
         else:
             self.post_command = post_cmd
@@ -412,13 +2838,158 @@ class TTagent(object):
             except:
                 return 1
     
+    def spool_msdata(self, data):
+        """ Append an unsent post to the spool, evicting the oldest ones to stay within spool_size bytes """
+        spool_size = int(self.config.get('spool_size', SPOOL_SIZE))
+        record = data + '\n'
+        if len(record) > spool_size:
+            return
+        current_size = self.repair_spool() if os.path.isfile(self.spoollog) else 0
+        if current_size + len(record) <= spool_size:
+            spool = open(self.spoollog, 'a')
+            spool.write(record)
+            spool.flush()
+            os.fsync(spool.fileno())
+            spool.close()
+            return
+        # Skip whole records from the head until the new one fits
+        spool = open(self.spoollog, 'r')
+        skipped = 0
+        for line in spool:
+            if current_size - skipped + len(record) <= spool_size:
+                break
+            skipped += len(line)
+        spool.close()
+        self.rewrite_spool(skipped, record)
+    
+    def repair_spool(self):
+        """ Cut a last record a crash left without its newline, so the next one is not appended to it, returns the spool size """
+        spool = open(self.spoollog, 'rb+')
+        spool.seek(0, 2)
+        size = end = spool.tell()
+        while end > 0:
+            start = max(0, end - 4096)
+            spool.seek(start)
+            chunk = spool.read(end - start)
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            spool.truncate(end)
+            spool.flush()
+            os.fsync(spool.fileno())
+        spool.close()
+        return end
+    
+    def drain_spool(self):
+        """ Resend up to spool_batch spooled posts, as one batch to batch_url if set else one by one at most spool_rate per second, dropping those the backend refuses with a 4xx """
+        if not os.path.isfile(self.spoollog):
+            return
+        batch = int(self.config.get('spool_batch', 20))
+        pause = 1.0 / float(self.config.get('spool_rate', 2))
+        spool = open(self.spoollog, 'r')
+        records = list()
+        at_end = False
+        for n in range(batch):
+            line = spool.readline()
+            # A record cut short by a crash has no newline, drop it with the rest
+            if not line.endswith('\n'):
+                at_end = True
+                break
+            records.append((line[:-1], spool.tell()))
+        spool.close()
+        sent = 0
+        stopped = False
+        batch_url = self.config.get('batch_url')
+        if batch_url and records:
+            deadline = time.time() + float(self.config.get('post_timeout', 30))
+            self.batch_conn, status = self.post_batch(self.batch_conn, batch_url, [record.encode('ascii') for record, end in records], deadline)
+            if status == 0 or status >= 500:
+                return
+            if 200 <= status < 300:
+                sent = records[-1][1]
+                records = list()
+            # A refused batch is resent one by one so only the posts post_url refuses are dropped
+        for n, (record, end) in enumerate(records):
+            if n:
+                time.sleep(pause)
+            if self.send_msdata(record) != 0:
+                if self.post_status is None or not 400 <= self.post_status < 500:
+                    # Backend or network down, try again after the next post
+                    stopped = True
+                    break
+                # Refused for good, resending it would hold back everything behind it
+                print("Error: Dropped a spooled post the backend refused with {0}".format(self.post_status))
+            sent = end
+        if at_end and not stopped:
+            sent = os.path.getsize(self.spoollog)
+        if sent > 0:
+            self.rewrite_spool(sent, '')
+    
+    def rewrite_spool(self, skip, extra):
+        """ Replace the spool with everything after its first skip bytes plus extra, atomically """
+        spool = open(self.spoollog, 'r')
+        spool.seek(skip)
+        tmp = open(self.spoollog + '.tmp', 'w')
+        while True:
+            chunk = spool.read(65536)
+            if not chunk:
+                break
+            tmp.write(chunk)
+        spool.close()
+        tmp.write(extra)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+        empty = (tmp.tell() == 0)
+        tmp.close()
+        if empty:
+            os.remove(self.spoollog + '.tmp')
+            os.remove(self.spoollog)
+        else:
+            os.rename(self.spoollog + '.tmp', self.spoollog)
+    
     def base64enc(self,instring):
-        outstring =  b64encode(instring)
+        if not isinstance(instring, bytes):
+            instring = instring.encode('utf8')
+        outstring =  b2a_base64(instring)
+        if not isinstance(outstring, str):
+            outstring = outstring.decode('ascii')
         outstring = outstring.strip('\n')    ###.strip('=')###
         outstring = outstring.replace('/','%2F').replace('+','%2B')
         return outstring
 
 
+def main():
+    """ Entry point, also for cron, which imports the agent as a module so its bytecode is cached """
+    if '--daemon' in sys.argv[1:]:
+        ttagent = TTagent(oneshot=False)
+        ttagent.daemon()
+    elif '--relay' in sys.argv[1:]:
+        ttagent = TTagent(oneshot=False)
+        ttagent.relay()
+    elif '--probe' in sys.argv[1:]:
+        ttagent = TTagent(oneshot=False)
+        ttagent.write_caps(ttagent.probe_caps())
+        print("Capabilities written to {0}".format(ttagent.capslog))
+    elif '--profile' in sys.argv[1:]:
+        ttagent = TTagent(oneshot=False)
+        ttagent.run()
+        ttagent.write_profile()
+        print(ttagent.profile_table())
+        if ttagent.post_status is not None:
+            print("post_msdata: HTTP {0} in {1:.2f} ms".format(ttagent.post_status, ttagent.post_latency))
+    elif '--splay' in sys.argv[1:]:
+        # Cron starts every host at second 0 of the minute tt-install.py picked for it, wait for our own second
+        ttagent = TTagent(oneshot=False)
+        if ttagent.config.get('splay', '1') == '1':
+            time.sleep(splay_offset(ttagent.splay_key(), CRON_PERIOD) % 60 + ttagent.splay_jitter(60))
+        ttagent.govern(cpu_limit=True)
+        ttagent.run()
+    else:
+        ttagent = TTagent()
+    sys.exit()
+
 if __name__ == '__main__':
-    ttagent = TTagent()
-    exit()
+    main()
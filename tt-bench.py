@@ -0,0 +1,714 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  tt-bench.py
+#  Code by: Tecqto.com
+#  Benchmarks the tt-agent.py collectors against a synthetic /proc and /sys tree
+#  Minimum Pythong Version: 2.7
+#
+#  Usage: python tt-bench.py generate DIR [--cores N] [--processes N] [--sockets N] [--mounts N] [--disks N] [--cgroups N]
+#         python tt-bench.py run DIR [--repeat N]
+#         python tt-bench.py cgroups DIR [--changed N] [--repeat N]
+#         python tt-bench.py encode DIR [--posts N]
+#         python tt-bench.py startup DIR [--python EXE]... [--repeat N] [--budget MS]
+#         python tt-bench.py relay [--agents N] [--posts N] [--fail N] [--refuse N] [--queue-size BYTES]
+#         python tt-bench.py post [--timeout S]
+#         python tt-bench.py splay [--hosts N] [--period S] [--jitter S] [--seed N]
+#
+
+import sys, os, time
+import struct, re, zlib, socket
+import subprocess
+import argparse
+from base64 import b64decode
+
+def load_agent():
+    """ Import tt-agent.py, its name is not a valid module name """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tt-agent.py')
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('ttagent', path)
+    spec = importlib.util.spec_from_file_location('ttagent', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def write_file(root, path, content):
+    path = os.path.join(root, path.lstrip('/'))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
+def generate_cpu(root, cores):
+    cpuinfo = list()
+    stat = ['cpu  {0} 0 {1} {2} {3} 0 {4} 0 0 0'.format(cores*5000, cores*2000, cores*90000, cores*1000, cores*100)]
+    for core in range(cores):
+        cpuinfo.append('processor\t: {0}\nvendor_id\t: GenuineIntel\nmodel name\t: Intel(R) Xeon(R) Platinum 8380 CPU @ 2.30GHz\n'
+                       'cpu MHz\t\t: 2300.000\ncache size\t: 61440 KB\ncpu cores\t: {1}\n\n'.format(core, cores))
+        stat.append('cpu{0} 5000 0 2000 90000 1000 0 100 0 0 0'.format(core))
+    stat.append('intr 0\nctxt 123456789\nbtime 1700000000\nprocesses 1000000\nprocs_running 3\nprocs_blocked 0\nsoftirq 0')
+    write_file(root, '/proc/cpuinfo', ''.join(cpuinfo))
+    write_file(root, '/proc/stat', '\n'.join(stat) + '\n')
+    write_file(root, '/sys/devices/system/cpu/possible', '0-{0}\n'.format(cores - 1))
+    write_file(root, '/sys/devices/system/cpu/online', '0-{0}\n'.format(cores - 1))
+
+def generate_processes(root, processes):
+    os.makedirs(os.path.join(root, 'proc', 'self'))
+    for pid in range(1, processes + 1):
+        # pid (comm) state ppid ... utime stime ... starttime vsize rss, 52 fields in all
+        fields = ['S', '1', str(pid), str(pid), '0', '-1', '4194560', '1000', '0', '0', '0',
+                  str(pid % 997), str(pid % 101), '0', '0', '20', '0', '1', '0', str(pid * 10), '104857600', str(pid % 4096)]
+        fields.extend(['0'] * 30)
+        write_file(root, '/proc/{0}/stat'.format(pid), '{0} (worker-{1}) {2}\n'.format(pid, pid % 64, ' '.join(fields)))
+        write_file(root, '/proc/{0}/io'.format(pid), 'rchar: 0\nwchar: 0\nsyscr: 0\nsyscw: 0\nread_bytes: {0}\nwrite_bytes: {1}\ncancelled_write_bytes: 0\n'.format(pid * 4096, pid * 512))
+
+def generate_network(root, sockets):
+    # Mostly established tcp, some time-wait and listening, a few udp
+    states = ['01'] * 6 + ['06', '06', '0A', '08']
+    tables = [('tcp', sockets * 7 // 10), ('tcp6', sockets * 2 // 10), ('udp', sockets // 20), ('udp6', sockets - sockets * 19 // 20)]
+    for table, count in tables:
+        path = os.path.join(root, 'proc', 'net', table)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'w')
+        width = 32 if table.endswith('6') else 8
+        # The kernel pads IPv4 lines to a fixed width, 150 bytes for tcp and 128 for udp
+        line = '{0:<149}\n' if table == 'tcp' else '{0:<127}\n' if table == 'udp' else '{0}\n'
+        f.write(line.format('  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode'))
+        chunk = list()
+        for sl in range(count):
+            chunk.append(line.format('{0:4d}: {1}:{2:04X} {3}:{4:04X} {5} 00000000:00000000 00:00000000 00000000  1000        0 {6} 1 0000000000000000 20 4 30 10 -1'.format(
+                sl, '0100007F'.zfill(width), sl % 65536, '0200A8C0'.zfill(width), 443, states[sl % len(states)], 100000 + sl)))
+            if len(chunk) == 10000:
+                f.write(''.join(chunk))
+                chunk = list()
+        f.write(''.join(chunk))
+        f.close()
+    write_file(root, '/proc/net/route', 'Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT\n'
+               'eth0\t00000000\t0100A8C0\t0003\t0\t0\t100\t00000000\t0\t0\t0\n'
+               'eth0\t0000A8C0\t00000000\t0001\t0\t0\t100\t00FFFFFF\t0\t0\t0\n')
+    write_file(root, '/proc/net/if_inet6', 'fe80000000000000020000fffe000001 02 40 20 80     eth0\n'
+               '20010db8000000000000000000000001 02 40 00 80     eth0\n'
+               '00000000000000000000000000000001 01 80 10 80       lo\n')
+    # Two uplinks bonded, with vlans on the bond
+    nics = ['lo', 'eth0', 'eth1', 'bond0'] + ['bond0.{0}'.format(vlan) for vlan in range(100, 116)]
+    dev = ['Inter-|   Receive                                                |  Transmit',
+           ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed']
+    for index, nic in enumerate(nics):
+        dev.append('{0:>6}: {1} {2} 0 {3} 0 0 0 0 {4} {5} 0 0 0 0 0 0'.format(nic, index * 123456789, index * 98765, index, index * 23456789, index * 8765))
+    write_file(root, '/proc/net/dev', '\n'.join(dev) + '\n')
+    write_file(root, '/sys/class/net/eth0/ifindex', '2\n')
+    write_file(root, '/sys/class/net/eth0/statistics/rx_bytes', '123456789012\n')
+    write_file(root, '/sys/class/net/eth0/statistics/tx_bytes', '98765432109\n')
+    write_file(root, '/sys/class/net/lo/ifindex', '1\n')
+
+def generate_mounts(root, mounts):
+    lines = ['proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0',
+             'sysfs /sys sysfs rw,nosuid,nodev,noexec,relatime 0 0',
+             '/dev/sda1 / ext4 rw,relatime 0 0']
+    mountinfo = ['23 1 0:22 / /proc rw,nosuid,nodev,noexec,relatime shared:5 - proc proc rw',
+                 '24 1 0:23 / /sys rw,nosuid,nodev,noexec,relatime shared:6 - sysfs sysfs rw',
+                 '1 0 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw']
+    for mount in range(mounts):
+        mountpoint = '/mnt/disk{0}'.format(mount)
+        os.makedirs(os.path.join(root, mountpoint.lstrip('/')))
+        lines.append('/dev/nvme{0}n1 {1} xfs rw,relatime 0 0'.format(mount, mountpoint))
+        lines.append('tmpfs /run/user/{0} tmpfs rw,nosuid,nodev,relatime 0 0'.format(mount))
+        mountinfo.append('{0} 1 259:{1} / {2} rw,relatime shared:{0} - xfs /dev/nvme{1}n1 rw'.format(100 + mount, mount, mountpoint))
+        mountinfo.append('{0} 1 0:{1} / /run/user/{2} rw,nosuid,nodev,relatime shared:{0} - tmpfs tmpfs rw'.format(1000 + mount, 100 + mount, mount))
+    write_file(root, '/proc/mounts', '\n'.join(lines) + '\n')
+    write_file(root, '/proc/self/mountinfo', '\n'.join(mountinfo) + '\n')
+
+def generate_disks(root, disks):
+    """ /proc/diskstats of disks NVMe namespaces with two partitions each, a dm device per two namespaces and loop devices """
+    lines = list()
+    devices = list()
+    for disk in range(disks):
+        devices.append((259, disk * 3, 'nvme{0}n1'.format(disk), True))
+        for part in (1, 2):
+            devices.append((259, disk * 3 + part, 'nvme{0}n1p{1}'.format(disk, part), False))
+    devices.extend([(253, dm, 'dm-{0}'.format(dm), True) for dm in range(disks // 2)])
+    devices.extend([(7, loop, 'loop{0}'.format(loop), True) for loop in range(8)])
+    for n, (major, minor, device, whole) in enumerate(devices):
+        # reads merged sectors ms writes merged sectors ms in_flight io_ms weighted_ms, then discards and flushes
+        lines.append('{0:4d} {1:7d} {2} {3} 0 {4} {5} {6} 0 {7} {8} 0 {9} {10} 0 0 0 0 0 0'.format(
+            major, minor, device, n * 1000, n * 8000, n * 300, n * 2000, n * 16000, n * 900, n * 700, n * 1200))
+        if whole:
+            os.makedirs(os.path.join(root, 'sys', 'block', device))
+    write_file(root, '/proc/diskstats', '\n'.join(lines) + '\n')
+
+def cgroup_groups(count):
+    """ Paths of count cgroups: services under system.slice, the rest kubernetes pods of three containers """
+    groups = ['system.slice'] + ['system.slice/service{0}.service'.format(n) for n in range(min(50, count - 2))] + ['kubepods.slice']
+    pod = 0
+    while len(groups) < count:
+        groups.append('kubepods.slice/pod{0}.slice'.format(pod))
+        for container in range(3):
+            if len(groups) < count:
+                groups.append('kubepods.slice/pod{0}.slice/container{1}.scope'.format(pod, container))
+        pod += 1
+    return groups
+
+def write_cgroup(root, group, usage_usec, rbytes, wbytes, memory):
+    """ The counter files of a group, with the interface files any group has besides """
+    path = '/sys/fs/cgroup/' + group
+    write_file(root, os.path.join(path, 'cpu.stat'), 'usage_usec {0}\nuser_usec {1}\nsystem_usec {2}\n'.format(usage_usec, usage_usec // 2, usage_usec - usage_usec // 2))
+    write_file(root, os.path.join(path, 'io.stat'), '8:0 rbytes={0} wbytes={1} rios=0 wios=0 dbytes=0 dios=0\n'.format(rbytes, wbytes))
+    write_file(root, os.path.join(path, 'memory.current'), '{0}\n'.format(memory))
+    for resource in ('cpu', 'memory', 'io'):
+        write_file(root, os.path.join(path, resource + '.pressure'), 'some avg10=0.50 avg60=0.25 avg300=0.10 total=12345\nfull avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+
+def generate_cgroups(root, count):
+    """ A cgroup v2 tree of count groups below the root group, each parent counting its children as the kernel does """
+    groups = cgroup_groups(count)
+    totals = dict((group, [0, 0, 0, 0]) for group in [''] + groups)
+    for n, group in enumerate(groups):
+        if group.endswith('.slice'):
+            continue
+        values = [(n % 97) * 1000003, (n % 13) * 4096 * 1000, (n % 7) * 4096 * 100, (n % 31) * 1048576]
+        # Every ancestor counts it too
+        path = group
+        while True:
+            totals[path] = [total + value for total, value in zip(totals[path], values)]
+            if not path:
+                break
+            path = path.rpartition('/')[0]
+    for group in groups:
+        write_cgroup(root, group, *totals[group])
+    write_file(root, '/sys/fs/cgroup/cgroup.controllers', 'cpuset cpu io memory hugetlb pids rdma misc\n')
+    write_file(root, '/sys/fs/cgroup/cgroup.stat', 'nr_descendants {0}\nnr_dying_descendants 0\n'.format(count))
+    write_file(root, '/sys/fs/cgroup/cpu.stat', 'usage_usec {0}\n'.format(totals[''][0]))
+
+def generate_misc(root):
+    write_file(root, '/etc/tecqto/tt-auth.log', 'benchmark\n')
+    write_file(root, '/etc/os-release', 'PRETTY_NAME="Debian GNU/Linux 12 (bookworm)"\nNAME="Debian GNU/Linux"\nVERSION_ID="12"\nID=debian\n')
+    write_file(root, '/proc/uptime', '1234567.89 98765432.10\n')
+    write_file(root, '/proc/loadavg', '12.50 11.75 10.03 5/123456 99999\n')
+    write_file(root, '/proc/sys/fs/file-nr', '123456\t0\t9223372036854775807\n')
+    write_file(root, '/proc/meminfo', 'MemTotal:       1056467000 kB\nMemFree:        12345678 kB\nMemAvailable:   876543210 kB\n'
+               'Buffers:          123456 kB\nCached:         765432100 kB\nSwapCached:            0 kB\n'
+               'SwapTotal:       8388604 kB\nSwapFree:        8000000 kB\nDirty:              4321 kB\nWriteback:             0 kB\n'
+               'SReclaimable:   2345678 kB\n')
+    write_file(root, '/proc/vmstat', ''.join(['{0} {1}\n'.format(name, value) for name, value in
+                                              (('nr_free_pages', 3086419), ('pswpin', 1200), ('pswpout', 3400), ('pgmajfault', 56789),
+                                               ('pgscan_kswapd', 123456), ('pgscan_direct', 789), ('oom_kill', 2))]))
+    for resource in ('cpu', 'memory', 'io'):
+        write_file(root, '/proc/pressure/' + resource, 'some avg10=1.50 avg60=0.75 avg300=0.30 total=123456789\nfull avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+    # glibc utmp records, ut_type 7 is a logged in user
+    utmp = b''
+    for session in range(20):
+        utmp += struct.pack('=h2xi32s4s32s256s4xi8x16x20x', 7, 1000 + session, b'pts/' + str(session).encode('ascii'),
+                            b'ts', b'user', b'10.0.0.1', session)
+    path = os.path.join(root, 'var', 'run', 'utmp')
+    os.makedirs(os.path.dirname(path))
+    f = open(path, 'wb')
+    f.write(utmp)
+    f.close()
+
+def generate(args):
+    if os.path.exists(args.root):
+        print("Error: {0} already exists".format(args.root))
+        sys.exit(1)
+    started = time.time()
+    generate_misc(args.root)
+    generate_cpu(args.root, args.cores)
+    generate_processes(args.root, args.processes)
+    generate_network(args.root, args.sockets)
+    generate_mounts(args.root, args.mounts)
+    generate_disks(args.root, args.disks)
+    generate_cgroups(args.root, args.cgroups)
+    print("Generated {0} in {1:.1f}s".format(args.root, time.time() - started))
+
+def peak_rss():
+    """ Peak resident size in kB of this process, from the real /proc """
+    f = open('/proc/self/status', 'r')
+    status = [line.split() for line in f.readlines()]
+    f.close()
+    return int([line[1] for line in status if line[0] == 'VmHWM:'][0])
+
+def measure(func, repeat):
+    """ Run func repeat times in a forked child, so peak memory is its own: (min ms, avg ms, peak kB) """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            try:
+                # Reset the peak resident size to the current one (Linux 4.0+)
+                f = open('/proc/self/clear_refs', 'w')
+                f.write('5')
+                f.close()
+            except IOError:
+                pass
+            base = peak_rss()
+            times = list()
+            for i in range(repeat):
+                started = time.time()
+                func()
+                times.append((time.time() - started) * 1000)
+            result = '{0} {1} {2}'.format(min(times), sum(times) / len(times), peak_rss() - base)
+        except Exception as e:
+            result = 'error {0}'.format(e)
+        os.write(wfd, result.encode('utf8'))
+        os._exit(0)
+    os.close(wfd)
+    result = b''
+    while True:
+        data = os.read(rfd, 4096)
+        if not data:
+            break
+        result += data
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return result.decode('utf8')
+
+def benchmark(args):
+    ttagent = load_agent()
+    
+    def new_agent():
+        agent = ttagent.TTagent(oneshot=False, root=args.root)
+        # Latency probes do not read the tree, keep them local and quick
+        agent.config.update({'latency_probe': 'tcp', 'latency_targets': 'eu=127.0.0.1:1', 'latency_deadline': '1'})
+        return agent
+    
+    def full_run():
+        agent = new_agent()
+        for collector, interval in agent.collectors:
+            getattr(agent, collector)()
+        agent.read_msdata()
+        agent.write_msdata()
+        agent.encode_msdata()
+    
+    def cpu_deltas():
+        # One interval of the per-core delta engine: parse, diff against the state file and rewrite it
+        agent.calc_load()
+        agent.read_msdata()
+        agent.write_msdata()
+    
+    agent = new_agent()
+    agent.calc_uptime()
+    agent.calc_connections()
+    print('{0:<24}{1:>10}{2:>10}{3:>10}'.format('collector', 'min ms', 'avg ms', 'peak kB'))
+    runs = [(collector, getattr(agent, collector)) for collector, interval in agent.collectors]
+    runs.append(('cpu deltas', cpu_deltas))
+    runs.append(('full run', full_run))
+    for name, func in runs:
+        result = measure(func, args.repeat)
+        if result.startswith('error'):
+            print('{0:<24}  {1}'.format(name, result))
+            continue
+        result = result.split()
+        print('{0:<24}{1:>10.2f}{2:>10.2f}{3:>10}'.format(name, float(result[0]), float(result[1]), result[2]))
+
+def cgroups(args):
+    """ Time calc_cgroups walking the whole fixture tree, then rereading it with --changed busy groups """
+    import random
+    ttagent = load_agent()
+    agent = ttagent.TTagent(oneshot=False, root=args.root)
+    groups = [group for group in cgroup_groups(len(agent.scan_cgroups(agent.find_cgroup_root())) - 1) if group.endswith('.scope') or group.endswith('.service')]
+    files = [0]
+    read_cgroup_file = agent.read_cgroup_file
+    
+    def counted(path):
+        files[0] += 1
+        return read_cgroup_file(path)
+    agent.read_cgroup_file = counted
+    
+    def bump(group):
+        # The group and every ancestor used another 10ms of cpu
+        path = group
+        while path:
+            stat = os.path.join(agent.find_cgroup_root(), path, 'cpu.stat')
+            usage = int(open(stat).read().split()[1]) + 10000
+            write_file('/', stat, 'usage_usec {0}\n'.format(usage))
+            path = path.rpartition('/')[0]
+    
+    print('{0:<28}{1:>10}{2:>10}{3:>12}'.format('pass', 'min ms', 'avg ms', 'files read'))
+    for name, changed in (('full walk', None), ('{0} changed'.format(args.changed), args.changed), ('none changed', 0)):
+        times = list()
+        for i in range(args.repeat):
+            if changed is None:
+                agent.cgroup_tree, agent.cgroup_prev = None, {}
+            else:
+                for group in random.sample(groups, changed):
+                    bump(group)
+            files[0] = 0
+            started = time.time()
+            agent.calc_cgroups()
+            times.append((time.time() - started) * 1000)
+        print('{0:<28}{1:>10.2f}{2:>10.2f}{3:>12}'.format(name, min(times), sum(times) / len(times), files[0]))
+    print('{0} groups, busiest: {1}'.format(len(agent.cgroup_prev) - 1, ', '.join([path for path, usage in agent.cgroups[:3]])))
+
+def unescape_post(value):
+    return value.replace('%2F', '/').replace('%2B', '+')
+
+def decode_post(body, bases):
+    """ {key: value} of a post body as the backend decodes it, bases holds the d1 fields by sequence number """
+    params = dict([param.split('=', 1) for param in body.split('&')])
+    if params.get('format') != 'd1':
+        # Every field on its own, in order
+        return [b64decode(unescape_post(field)).decode('utf8') for field in params['data'].split(' ')]
+    text = zlib.decompress(b64decode(unescape_post(params['data']))).decode('utf8')
+    lines = text.split('\n')
+    version, seq, base = lines[0].split()
+    if int(base) not in bases and int(base) != 0:
+        raise ValueError('unknown base {0}'.format(base))
+    fields = dict(bases.get(int(base), {}))
+    for line in lines[1:]:
+        if line.startswith('-'):
+            del fields[line[1:]]
+            continue
+        key, value = line.split('\t', 1)
+        fields[key] = re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n'}.get(m.group(1), m.group(1)), value)
+    bases[int(seq)] = fields
+    return fields
+
+def encoders(args):
+    """ Size and encode time of every post format over a run of posts, each decoded back and checked """
+    ttagent = load_agent()
+    agent = ttagent.TTagent(oneshot=False, root=args.root)
+    agent.config.update({'latency_probe': 'tcp', 'latency_targets': 'eu=127.0.0.1:1', 'latency_deadline': '1'})
+    # Start every format from no acknowledged post
+    if os.path.isfile(agent.postlog):
+        os.remove(agent.postlog)
+    for collector, interval in agent.collectors:
+        getattr(agent, collector)()
+    formats = sorted(agent.encoders)
+    sizes = dict((name, list()) for name in formats)
+    times = dict((name, list()) for name in formats)
+    bases = {}
+    for post in range(args.posts):
+        # What changes between posts
+        for collector in ('calc_uptime', 'calc_processes', 'calc_connections', 'calc_load'):
+            getattr(agent, collector)()
+        agent.read_msdata()
+        agent.write_msdata()
+        for name in formats:
+            agent.config['post_format'] = name
+            started = time.time()
+            agent.encode_msdata()
+            times[name].append((time.time() - started) * 1000)
+            sizes[name].append(len(agent.data_post))
+            decoded = decode_post(agent.data_post, bases)
+            expected = agent.data_post_plain
+            if isinstance(decoded, dict):
+                expected = dict(agent.post_fields(expected))
+                agent.ack_post(0)
+            if decoded != expected:
+                print("Error: {0} post {1} does not decode to what was encoded".format(name, post))
+                sys.exit(1)
+    print('{0:<12}{1:>12}{2:>12}{3:>12}{4:>12}'.format('format', 'first B', 'avg B', 'total B', 'avg ms'))
+    for name in formats:
+        print('{0:<12}{1:>12}{2:>12.0f}{3:>12}{4:>12.2f}'.format(name, sizes[name][0], sum(sizes[name]) / float(len(sizes[name])),
+                                                                sum(sizes[name]), sum(times[name]) / len(times[name])))
+    print("All {0} posts decoded to the encoded fields".format(args.posts))
+
+# Run in a fresh interpreter up to where the first collector starts: the agent compiled from source as
+# `python tt-agent.py` does, or imported through the ttagent.py link with its bytecode cached as cron does
+STARTUP_CHILD = """
+import sys, time
+path, root, mode = sys.argv[1:4]
+if mode == 'script':
+    ttagent = {'__name__': 'ttagent', '__file__': path}
+    exec(compile(open(path).read(), path, 'exec'), ttagent)
+    TTagent = ttagent['TTagent']
+else:
+    sys.path.insert(0, path)
+    from ttagent import TTagent
+TTagent(oneshot=False, root=root)
+sys.stdout.write('{0!r} {1}'.format(time.time(), len(sys.modules)))
+"""
+
+def startup(args):
+    """ Interpreter start to first collector, per interpreter and way of starting, against the startup budget """
+    import tempfile, shutil
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tt-agent.py')
+    # The link the installer makes next to tt-agent.py, in a scratch directory for its cached bytecode
+    linkdir = tempfile.mkdtemp()
+    os.symlink(path, os.path.join(linkdir, 'ttagent.py'))
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    print('{0:<40}{1:>8}{2:>10}{3:>10}{4:>10}'.format('interpreter', 'start', 'min ms', 'avg ms', 'modules'))
+    over = False
+    try:
+        for python in args.python or [sys.executable]:
+            for mode, target in (('script', path), ('module', linkdir)):
+                times = list()
+                # One more run first, so the module start finds its bytecode cached
+                for i in range(args.repeat + 1):
+                    started = time.time()
+                    child = subprocess.Popen([python, '-c', STARTUP_CHILD, target, args.root, mode], stdout=subprocess.PIPE, env=env)
+                    output = child.communicate()[0].decode('ascii').split()
+                    if child.returncode != 0:
+                        print("Error: {0} could not start the agent".format(python))
+                        sys.exit(1)
+                    times.append((float(output[0]) - started) * 1000)
+                times = times[1:]
+                if mode == 'module':
+                    over = over or min(times) > args.budget
+                print('{0:<40}{1:>8}{2:>10.1f}{3:>10.1f}{4:>10}'.format(python, mode, min(times), sum(times) / len(times), output[1]))
+    finally:
+        shutil.rmtree(linkdir)
+    if over:
+        print("Error: the module start is over the {0:.0f} ms budget".format(args.budget))
+        sys.exit(1)
+
+def relay(args):
+    """ Agents posting through a relay to a stand-in upstream, all on localhost, checking every post arrives once """
+    import threading, tempfile, shutil
+    try:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+    except ImportError:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    received = list()
+    connections = set()
+    failures = [args.fail]
+    
+    class Upstream(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def do_POST(self):
+            body = zlib.decompress(self.rfile.read(int(self.headers['Content-Length'])), 16 + zlib.MAX_WBITS)
+            connections.add(self.client_address)
+            if failures[0] > 0:
+                # Down for the first batches, the relay has to retry them
+                failures[0] -= 1
+                self.send_response(503)
+            elif b'data=refused' in body:
+                # The relay has to find the refused post and forward the rest
+                self.send_response(400)
+            else:
+                received.append(body.split(b'\n'))
+                self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+        
+        def log_message(self, format, *args):
+            pass
+    
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+    
+    def serve(server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    
+    upstream = Server(('127.0.0.1', 0), Upstream)
+    serve(upstream)
+    # Agents and relay under a scratch root of their own, they write their logs below /etc/tecqto of it
+    root = tempfile.mkdtemp()
+    write_file(root, '/etc/tecqto/tt-auth.log', 'benchmark\n')
+    try:
+        ttagent = load_agent()
+        relay_agent = ttagent.TTagent(oneshot=False, root=root)
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        relay_port = probe.getsockname()[1]
+        probe.close()
+        relay_agent.config.update({'relay_listen': '127.0.0.1:{0}'.format(relay_port), 'relay_flush': '0.2',
+                                   'relay_queue_size': str(args.queue_size),
+                                   'relay_upstream': 'http://127.0.0.1:{0}/batch'.format(upstream.server_address[1])})
+        thread = threading.Thread(target=relay_agent.relay)
+        thread.daemon = True
+        thread.start()
+    
+        sent = list()
+        rejected = [0]
+        refused = [0]
+    
+        def agent_posts(n):
+            agent = ttagent.TTagent(oneshot=False, root=root)
+            agent.config.update({'post_url': 'http://127.0.0.1:{0}/fetch-server-data'.format(relay_port), 'post_gzip': str(n % 2)})
+            for post in range(args.posts):
+                data = 'token=agent{0}&data={1}{2}'.format(n, 'refused' if post < args.refuse and n == 0 else 'post', post)
+                if agent.send_msdata(data) == 0:
+                    sent.append(data.encode('ascii'))
+                elif agent.post_status == 400:
+                    refused[0] += 1
+                else:
+                    rejected[0] += 1
+    
+        time.sleep(0.2)
+        started = time.time()
+        agents = [threading.Thread(target=agent_posts, args=(n,)) for n in range(args.agents)]
+        for agent in agents:
+            agent.start()
+        for agent in agents:
+            agent.join()
+        # Posts refused upstream after the relay answered 202 were counted as sent
+        expected = sorted([post for post in sent if b'data=refused' not in post])
+        deadline = time.time() + 60
+        while sum([len(batch) for batch in received]) < len(expected) and time.time() < deadline:
+            time.sleep(0.05)
+        # The relay stamps live posts with the time they arrived
+        forwarded = [post.split(b'&time=')[0] for batch in received for post in batch if b'&time=' in post]
+        print("{0} posts from {1} agents in {2:.2f}s, {3} turned away, {4} refused upstream".format(len(sent), args.agents, time.time() - started,
+                                                                                                 rejected[0], refused[0]))
+        print("Upstream got {0} posts in {1} batches over {2} connections, {3} failed batches retried".format(
+            len(forwarded), len(received), len(connections), args.fail))
+        if sorted(forwarded) != expected:
+            print("Error: upstream did not get every accepted post exactly once")
+            sys.exit(1)
+    finally:
+        shutil.rmtree(root)
+
+def post(args):
+    """ Posts against a local stand-in backend that answers, trickles its reply or never answers, all within post_timeout """
+    import threading, tempfile, shutil
+    reply = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+    
+    def handle(conn, mode):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            chunk = conn.recv(65536)
+            if not chunk:
+                conn.close()
+                return
+            request += chunk
+        head, body = request.split(b'\r\n\r\n', 1)
+        length = int(re.search(b'Content-Length: *([0-9]+)', head, re.I).group(1))
+        while len(body) < length:
+            body += conn.recv(65536)
+        try:
+            if mode == 'answer':
+                conn.sendall(reply)
+                # Kept alive for the next post
+                return handle(conn, mode)
+            if mode == 'trickle':
+                # One byte at a time, each read on its own well within a socket timeout
+                for pos in range(len(reply)):
+                    conn.sendall(reply[pos:pos+1])
+                    time.sleep(0.5)
+            elif mode == 'silent':
+                time.sleep(args.timeout * 5)
+        except socket.error:
+            pass
+        conn.close()
+    
+    def serve(listener, mode):
+        while True:
+            conn = listener.accept()[0]
+            thread = threading.Thread(target=handle, args=(conn, mode))
+            thread.daemon = True
+            thread.start()
+    
+    ttagent = load_agent()
+    root = tempfile.mkdtemp()
+    write_file(root, '/etc/tecqto/tt-auth.log', 'benchmark\n')
+    late = False
+    try:
+        print('{0:<12}{1:>8}{2:>10}'.format('backend', 'result', 'seconds'))
+        for mode in ('answer', 'trickle', 'silent'):
+            listener = socket.socket()
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(16)
+            thread = threading.Thread(target=serve, args=(listener, mode))
+            thread.daemon = True
+            thread.start()
+            agent = ttagent.TTagent(oneshot=False, root=root)
+            agent.config.update({'post_url': 'http://localhost:{0}/fetch-server-data'.format(listener.getsockname()[1]),
+                                 'post_timeout': str(args.timeout)})
+            for n in range(2):
+                started = time.time()
+                retcode = agent.send_msdata('token=benchmark&data=post{0}'.format(n))
+                elapsed = time.time() - started
+                print('{0:<12}{1:>8}{2:>10.2f}'.format(mode, 'sent' if retcode == 0 else 'failed', elapsed))
+                late = late or elapsed > args.timeout + 0.5 or (mode == 'answer') != (retcode == 0)
+    finally:
+        shutil.rmtree(root)
+    if late:
+        print("Error: a post did not end as expected within post_timeout")
+        sys.exit(1)
+
+def splay(args):
+    """ Posts per second arriving upstream from --hosts agents over one period, without and with splay """
+    import random
+    ttagent = load_agent()
+    random.seed(args.seed)
+    hosts = ['token{0}'.format(random.randint(0, 999)) + '%032x' % random.getrandbits(128) for host in range(args.hosts)]
+    # Collecting and posting takes a while, a fast and a slow host differ
+    runtimes = [random.uniform(0.05, 2.0) for host in hosts]
+    
+    def cron(key, jitter):
+        # The minute from the crontab, the second the agent sleeps for with --splay
+        offset = ttagent.splay_offset(key, args.period)
+        return (offset // 60) * 60 + offset % 60 + random.uniform(0, min(jitter, 30))
+    
+    def daemon(key, jitter):
+        # next_slot: the offset into post_interval plus jitter
+        return ttagent.splay_offset(key, args.period) + random.uniform(0, min(jitter, args.period / 2))
+    
+    runs = [('no splay', lambda key: 0.0),
+            ('cron, splay', lambda key: cron(key, 0)),
+            ('cron, jitter {0:g}s'.format(args.jitter), lambda key: cron(key, args.jitter)),
+            ('daemon, splay', lambda key: daemon(key, 0)),
+            ('daemon, jitter {0:g}s'.format(args.jitter), lambda key: daemon(key, args.jitter))]
+    buckets = 18
+    print('{0} hosts, one post each every {1}s, {2:.1f} posts/s on average'.format(args.hosts, args.period, float(args.hosts) / args.period))
+    print('{0:<22}{1:>10}{2:>10}{3:>12}   posts per {4}s of the period'.format('schedule', 'peak/s', 'p99/s', 'idle secs', args.period // buckets))
+    for name, start in runs:
+        per_second = [0] * int(args.period)
+        for key, runtime in zip(hosts, runtimes):
+            per_second[int(start(key) + runtime) % int(args.period)] += 1
+        ranked = sorted(per_second)
+        spread = [sum(per_second[n * len(per_second) // buckets:(n + 1) * len(per_second) // buckets]) for n in range(buckets)]
+        bars = ''.join([' .:-=+*#%@'[min(9, int(9.0 * count / max(spread) + 0.999))] for count in spread])
+        print('{0:<22}{1:>10}{2:>10}{3:>12}   |{4}|'.format(name, ranked[-1], ranked[min(len(ranked) - 1, int(len(ranked) * 0.99))], per_second.count(0), bars))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark tt-agent.py collectors on a synthetic /proc and /sys tree')
+    commands = parser.add_subparsers(dest='command')
+    gen = commands.add_parser('generate', help='write a fixture tree')
+    gen.add_argument('root')
+    gen.add_argument('--cores', type=int, default=512)
+    gen.add_argument('--processes', type=int, default=100000)
+    gen.add_argument('--sockets', type=int, default=1000000)
+    gen.add_argument('--mounts', type=int, default=300)
+    gen.add_argument('--disks', type=int, default=300, help='NVMe namespaces in /proc/diskstats')
+    gen.add_argument('--cgroups', type=int, default=5000)
+    gen.set_defaults(func=generate)
+    bench = commands.add_parser('run', help='time every collector and a full agent run against a fixture tree')
+    bench.add_argument('root')
+    bench.add_argument('--repeat', type=int, default=3)
+    bench.set_defaults(func=benchmark)
+    cgr = commands.add_parser('cgroups', help='time full and incremental cgroup reads of a fixture tree')
+    cgr.add_argument('root')
+    cgr.add_argument('--changed', type=int, default=50, help='groups that used cpu between incremental reads')
+    cgr.add_argument('--repeat', type=int, default=5)
+    cgr.set_defaults(func=cgroups)
+    enc = commands.add_parser('encode', help='compare post formats and check they decode back')
+    enc.add_argument('root')
+    enc.add_argument('--posts', type=int, default=20)
+    enc.set_defaults(func=encoders)
+    start = commands.add_parser('startup', help='time interpreter start to first collector')
+    start.add_argument('root')
+    start.add_argument('--python', action='append', help='interpreter to time, repeat for several')
+    start.add_argument('--repeat', type=int, default=10)
+    start.add_argument('--budget', type=float, default=60, help='most ms the fastest module start may take')
+    start.set_defaults(func=startup)
+    rel = commands.add_parser('relay', help='post through a relay to a local stand-in upstream')
+    rel.add_argument('--agents', type=int, default=50)
+    rel.add_argument('--posts', type=int, default=20)
+    rel.add_argument('--fail', type=int, default=2, help='batches the upstream turns away first')
+    rel.add_argument('--refuse', type=int, default=2, help='posts of the first agent the upstream refuses with 400')
+    rel.add_argument('--queue-size', type=int, default=64 * 1024 * 1024, help='relay queue bytes, small values show backpressure')
+    rel.set_defaults(func=relay)
+    pst = commands.add_parser('post', help='post to local stand-in backends that answer slowly or never')
+    pst.add_argument('--timeout', type=float, default=2, help='post_timeout seconds')
+    pst.set_defaults(func=post)
+    spl = commands.add_parser('splay', help='simulate when a fleet of agents posts within a period')
+    spl.add_argument('--hosts', type=int, default=10000)
+    spl.add_argument('--period', type=int, default=180, help='seconds between posts, as CRON_PERIOD or post_interval')
+    spl.add_argument('--jitter', type=float, default=5, help='splay_jitter seconds')
+    spl.add_argument('--seed', type=int, default=1)
+    spl.set_defaults(func=splay)
+    args = parser.parse_args()
+    args.func(args)
@@ -14,12 +14,20 @@ import os, sys, time
 from shutil import rmtree
 import subprocess
 
+# Python 3 renamed raw_input
+try:
+    input = raw_input
+except NameError:
+    pass
+
 def check_output(*popenargs, **kwargs):
     """ check_output method from subprocess module after Python 2.7 """
     if 'stdout' in kwargs:
         raise ValueError('stdout argument not allowed, it will be overridden.')
     process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
     output, unused_err = process.communicate()
+    if not isinstance(output, str):
+        output = output.decode('utf8', 'replace')
     retcode = process.poll()
     if retcode:
         cmd = kwargs.get("args")
@@ -31,10 +39,17 @@ def check_output(*popenargs, **kwargs):
 tecqto_dir = '/etc/tecqto'
 tecqto_agent = 'tt-agent.py'
 tecqto_agent_path = os.path.join(tecqto_dir,tecqto_agent)
+# Importable name for tt-agent.py, so cron runs get its bytecode cached instead of compiling it every time
+tecqto_module = 'ttagent'
+tecqto_module_path = os.path.join(tecqto_dir,tecqto_module + '.py')
 tecqto_cronlog = 'tt-cron.log'
 tecqto_cronlog_path = os.path.join(tecqto_dir,tecqto_cronlog)
 tecqto_authlog = 'tt-auth.log'
 tecqto_authlog_path = os.path.join(tecqto_dir,tecqto_authlog)
+tecqto_pidfile = 'tt-agent.pid'
+tecqto_pidfile_path = os.path.join(tecqto_dir,tecqto_pidfile)
+# Seconds between agent runs, as CRON_PERIOD in tt-agent.py
+tecqto_cron_period = 180
 
 print("|\n|   Tecqto-Agent Installer\n|   ===================\n|")
 
@@ -43,8 +58,9 @@ if os.getuid() != 0:
     print("|          The agent itself will NOT be running as root but instead under its own non-privileged user\n|")
     sys.exit(1)
 
-if len(sys.argv) != 2:
-    print("|   Usage: {0} 'token'\n|".format(sys.argv[0]))
+# --daemon or --cron picks how the agent runs without asking, as unattended installs need
+if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] not in ('--daemon', '--cron')):
+    print("|   Usage: {0} 'token' [--daemon|--cron]\n|".format(sys.argv[0]))
     sys.exit(1)
 
 
@@ -63,7 +79,7 @@ def is_crontab_available():
 
 if not is_crontab_available():
     print("|")
-    installvar = raw_input("|   Crontab is required and could not be found. Do you want to install it? [Y/n] ")
+    installvar = input("|   Crontab is required and could not be found. Do you want to install it? [Y/n] ")
     if (installvar=='Y') or (installvar=='y'):
         if distro_family == 'debian':
             print("|\n|   Notice: Installing required package 'cron' via 'apt-get'")
@@ -105,7 +121,7 @@ def is_cron_running():
 
 if not is_cron_running():
     print("|")
-    startcronflag = raw_input("|   Cron is available but not running. Do you want to start it? [Y/n] ")
+    startcronflag = input("|   Cron is available but not running. Do you want to start it? [Y/n] ")
     if (startcronflag=='Y') or (startcronflag=='y'):
         if distro_family == 'debian':
             print("|\n|   Notice: Starting 'cron' via 'service'")
@@ -131,7 +147,7 @@ if not is_cron_running():
     if not is_cron_running():
         print("|\n|   Error: Cron is available but could not be started\n|")
         print("|   It is possible that Cron is running but not detected correctly.")
-        continue_anyway = raw_input("|   Do you still wish to continue? [Y/n] ")
+        continue_anyway = input("|   Do you still wish to continue? [Y/n] ")
         if (continue_anyway=='Y') or (continue_anyway=='y'):
             pass
         else:
@@ -147,9 +163,7 @@ def add_user_tecqto():
     status = ( subprocess.call(['useradd','tecqto','-r','-d',tecqto_dir,'-s','/bin/false']) == 0 )
     subprocess.call(['chown', '-R', 'tecqto:tecqto', tecqto_dir])
     subprocess.call(['chmod', '-R', '700', tecqto_dir])
-    r = os.system('chmod +s `type -p ping` 2>/dev/null')
-    if r!=0:
-        os.system('chmod +s `command -v ping`')
+    # No setuid ping needed, the agent probes latency over ICMP datagram or TCP sockets
     return status
 
 def del_user_tecqto():
@@ -160,6 +174,8 @@ def read_crontab(user):
     crontab_cmd = ['crontab', '-u', user, '-l']
     crontab_proc = subprocess.Popen(crontab_cmd, stdout=subprocess.PIPE)
     crontable = crontab_proc.stdout.read()
+    if not isinstance(crontable, str):
+        crontable = crontable.decode('utf8')
     return crontable
 
 def search_in_crontab(crontable):
@@ -171,16 +187,58 @@ def search_in_crontab(crontable):
 def cron_edit(user, crontablenew):
     cron_fromstdin = ['crontab', '-u', user, '-']
     cron_edit = subprocess.Popen(cron_fromstdin, stdin=subprocess.PIPE)
-    cron_edit.communicate(crontablenew)
+    cron_edit.communicate(crontablenew.encode('utf8'))
     time.sleep(1)
     if cron_edit.poll() == None:
         cron_edit.terminate()
 
-def crontab_add_tecqto(user, crontable):
-    crontable_new = crontable + "*/3 * * * * python {0} > {1} 2>&1\n".format(tecqto_agent_path,tecqto_cronlog_path)
+def splay_offset(key, period):
+    """ Seconds into every period this host starts at, splay_offset in tt-agent.py computes the same """
+    import hashlib
+    digest = hashlib.md5(key.encode('utf8')).hexdigest()
+    return int(digest[:8], 16) % int(period * 1000) / 1000.0
+
+def splay_key():
+    """ The token and the machine id, as the agent's splay_key """
+    authlog = open(tecqto_authlog_path, 'r')
+    token = authlog.read().split()[0]
+    authlog.close()
+    machine_id = os.uname()[1]
+    for path in ('/etc/machine-id', '/var/lib/dbus/machine-id'):
+        if os.path.isfile(path):
+            f = open(path, 'r')
+            machine_id = f.read().strip()
+            f.close()
+            break
+    return token + machine_id
+
+def crontab_add_tecqto(user, crontable, daemon=False):
+    # The interpreter installing is the one running the agent, imported through tecqto_module_path
+    agent_cmd = "{0} -c 'import sys; sys.path.insert(0, \"{1}\"); import {2}; {2}.main()'".format(sys.executable, tecqto_dir, tecqto_module)
+    # Not every host at once: this host's minute of the period, the agent waits for its second with --splay
+    period = tecqto_cron_period // 60
+    schedule = "{0}-59/{1} * * * *".format(int(splay_offset(splay_key(), tecqto_cron_period) // 60), period)
+    # The trailing comment names tecqto_agent_path for search_in_crontab and crontab_remove_tecqto
+    if daemon:
+        # Cron only (re)starts the resident agent, a running daemon keeps its lock and this exits at once
+        crontable_new = crontable + "{0} {1} --daemon >> {2} 2>&1 # {3}\n".format(schedule,agent_cmd,tecqto_cronlog_path,tecqto_agent_path)
+    else:
+        crontable_new = crontable + "{0} {1} --splay > {2} 2>&1 # {3}\n".format(schedule,agent_cmd,tecqto_cronlog_path,tecqto_agent_path)
     cron_edit(user, crontable_new)
     return 0
 
+def stop_daemon_tecqto():
+    if not os.path.isfile(tecqto_pidfile_path):
+        return False
+    try:
+        pidfile = open(tecqto_pidfile_path, 'r')
+        pid = int(pidfile.read().split()[0])
+        pidfile.close()
+        os.kill(pid, 15)
+        return True
+    except:
+        return False
+
 def crontab_remove_tecqto(user, crontable):
     crontab_list = crontable.split('\n')
     res = [crontab_list.remove(entry) for entry in crontab_list if tecqto_agent_path in entry]
@@ -190,6 +248,7 @@ def crontab_remove_tecqto(user, crontable):
     return removed_entries
 
 if os.path.isfile(tecqto_agent_path):
+    stop_daemon_tecqto()
     rmtree(tecqto_dir)
     if exists_user('tecqto'):
         crontable = read_crontab('tecqto')
@@ -215,6 +274,8 @@ dl.wait()
 
 # Make tt-agent.py executable
 subprocess.call(['chmod','a+x',tecqto_agent_path])
+if os.path.isfile(tecqto_agent_path) and not os.path.islink(tecqto_module_path):
+    os.symlink(tecqto_agent, tecqto_module_path)
 
 # If successful, proceed
 if os.path.isfile(tecqto_agent_path):
@@ -225,13 +286,29 @@ if os.path.isfile(tecqto_agent_path):
     subprocess.call(['chmod', 'a-x', tecqto_authlog_path])
     
     add_user_tecqto()
+    print("|")
+    if len(sys.argv) == 3:
+        daemon = (sys.argv[2] == '--daemon')
+    elif sys.stdin.isatty():
+        try:
+            daemonflag = input("|   Run the agent as a resident daemon instead of starting it every 3 minutes? [y/N] ")
+        except EOFError:
+            daemonflag = ''
+        daemon = (daemonflag=='Y') or (daemonflag=='y')
+    else:
+        # Nobody to ask, e.g. piped from curl
+        daemon = False
     crontable = read_crontab('tecqto')
-    crontab_add_tecqto('tecqto', crontable)
+    crontab_add_tecqto('tecqto', crontable, daemon)
     print("|\n|   Success: The Tecqto agent has been installed\n|")
     
+    # The agent reads which tools and sources this host has from tt-caps.json instead of probing every run
+    print("|\n|   Probing host capabilities... \n|")
+    subprocess.call([sys.executable,tecqto_agent_path,'--probe'])
+    
     print("|\n|   Running Tecqto agent now... \n|")
-    subprocess.call(['python',tecqto_agent_path])
-    # Fix permissions for newly created tt-agent.log and tt-data.log
+    subprocess.call([sys.executable,tecqto_agent_path])
+    # Fix permissions for newly created tt-agent.log and tt-state.dat
     for f in os.listdir(tecqto_dir):
         subprocess.call(['chown', 'tecqto:tecqto', os.path.join(tecqto_dir,f)])
     
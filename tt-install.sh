@@ -22,31 +22,33 @@ fi
 # Parameters required
 if [ $# -lt 1 ]
 then
-	echo -e "|   Usage: bash $0 'token'\n|"
+	echo -e "|   Usage: bash $0 'token' [--daemon|--cron]\n|"
 	exit 1
 fi
 
-echo -e "This software requires Python version 2 to be installed."
-echo -e "Detecting if Python 2 is available...\n"
+echo -e "This software requires Python 2.7 or Python 3 to be installed."
+echo -e "Detecting if Python is available...\n"
 
-if [ -n "$(command -v python)" ]
-then
-	PYTHONCOMMAND="python"
-elif [ -n "$(command -v python2)" ]
-then
-	PYTHONCOMMAND="python2"
-fi
+# Python 3 first, plain python may still be Python 2 on older systems
+for candidate in python3 python python2
+do
+	if [ -n "$(command -v $candidate)" ]
+	then
+		PYTHONCOMMAND="$candidate"
+		break
+	fi
+done
 
 pyv="$($PYTHONCOMMAND -V 2>&1 | awk '{ print $2 }' | cut -d'.' -f1)"
 
-if [ $pyv == '2' ]
+if [ "$pyv" == '2' ] || [ "$pyv" == '3' ]
 then
-	echo -e "Python 2 found. Proceeding with Tecqto-Agent installation...\n"
+	echo -e "Python $pyv found. Proceeding with Tecqto-Agent installation...\n"
 	mkdir -p /etc/tecqto
 	echo -e "Downloading tt-install.py to /etc/tecqto\n   + $(wget -nv -o /dev/stdout -O /etc/tecqto/tt-install.py --no-check-certificate https://raw.githubusercontent.com/tecqto/tt-agent/master/tt-install.py)"
 	if [ -f /etc/tecqto/tt-install.py ]
 then
-	$PYTHONCOMMAND /etc/tecqto/tt-install.py $1
+	$PYTHONCOMMAND /etc/tecqto/tt-install.py $1 $2
 else
 	# Error Display
 	echo -e "\n Error: Tecqto-Agent Unable to Download - Tecqto-Agent Can't be Installed"
@@ -54,8 +56,8 @@ else
 fi
 	exit 0
 else
-	echo "You do not have Python 2 installed."
-	echo "Python 2 is required to run this program."
-	echo "Please install Python 2 first.\n"
+	echo "You do not have Python installed."
+	echo "Python 2.7 or Python 3 is required to run this program."
+	echo "Please install Python 3 first.\n"
 	exit 1
 fi